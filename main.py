@@ -1,5 +1,15 @@
-def main():
-    print("cancer-cell-portal-utils")
+"""
+cancer-cell-portal-utils command line interface, see scripts/cli.py
+
+    python main.py extract -i ./data/web
+    python main.py proportions -i ./data/web -g groups.txt
+    python main.py transform
+    python main.py upload -i output.json
+    python main.py index -i ./data/web -q ENSG00000141510
+    python main.py rechunk -i dataset.h5ad
+    python main.py convert -i dataset.h5ad
+"""
+from scripts.cli import main
 
 
 if __name__ == "__main__":
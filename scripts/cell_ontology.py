@@ -0,0 +1,155 @@
+"""
+Harmonize free-text cell type labels to Cell Ontology (CL) terms.
+
+Datasets that were not curated for CellxGene (btc-gbm, msk-scope) do not
+have a `cell_type` column, instead they may have computed annotations in
+`celltype_L1/L2/L3`-style columns with free-text labels.
+
+The index is built once from the CL ontology shipped with cellxgene-schema
+(via cellxgene-ontology-guide) and resolves a label by, in order:
+1. CL term id, e.g. CL:0000084
+2. Exact label, e.g. "T cell"
+3. Exact synonym, e.g. "T lymphocyte"
+4. Normalized tokens, e.g. "T-Cells", "NK cells", "Fibroblasts", "Epithelial"
+
+Labels are only ever resolved per unique category/combination of
+categories, never per cell, and resolved labels are LRU cached.
+"""
+import re
+from collections import defaultdict
+from functools import cache, lru_cache
+from typing import Iterable
+
+import pandas as pd
+
+CL_ID_PATTERN = re.compile(r'^CL:\d{7}$')
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+\+?')
+
+# e.g. cell_type, celltype, celltype_L1, cell_type_l2, CellType_L3
+CELL_TYPE_COLUMN_PATTERN = re.compile(r'^cell_?type(_?l(?P<level>\d+))?$', re.IGNORECASE)
+
+UNKNOWN = 'unknown'
+
+
+def normalize(label: str) -> tuple[str, ...]:
+    """
+    Order-insensitive bag of tokens for fuzzy matching
+    "CD8+ T-cells" -> ('cd8', 'cell', 'positive', 't')
+    """
+    tokens = set()
+    for token in TOKEN_PATTERN.findall(label.lower()):
+        if token.endswith('+'):
+            tokens.update((token[:-1], 'positive'))
+            continue
+        # Singularize, e.g. cells, macrophages, but not e.g. glass
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.add(token)
+    return tuple(sorted(tokens))
+
+
+class CellOntologyIndex:
+    """In-memory lookup tables over the CL ontology"""
+
+    def __init__(self, ontology: dict, cache_size: int = 4096):
+        self.terms = {
+            term_id: term for term_id, term in ontology.items()
+            if not term.get('deprecated', False)
+        }
+        self.labels: dict[str, str] = {}
+        self.synonyms: dict[str, str] = {}
+        self.tokens: dict[tuple[str, ...], str] = {}
+
+        # Labels take precedence over synonyms for normalized tokens
+        for term_id, term in self.terms.items():
+            self.labels.setdefault(term['label'].casefold(), term_id)
+            self.tokens.setdefault(normalize(term['label']), term_id)
+        for term_id, term in self.terms.items():
+            for synonym in term.get('synonyms', []):
+                self.synonyms.setdefault(synonym.casefold(), term_id)
+                self.tokens.setdefault(normalize(synonym), term_id)
+
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    @classmethod
+    def from_cellxgene_schema(cls, version: str | None = None, **kwargs) -> 'CellOntologyIndex':
+        from cellxgene_ontology_guide.supported_versions import CXGSchema
+        return cls(CXGSchema(version=version).ontology('CL'), **kwargs)
+
+    def _resolve(self, label: str) -> str | None:
+        """Return: the CL term id for a free-text label, None if unresolved"""
+        label = label.strip()
+        if CL_ID_PATTERN.match(label):
+            return label if label in self.terms else None
+        key = label.casefold()
+        if key in self.labels:
+            return self.labels[key]
+        if key in self.synonyms:
+            return self.synonyms[key]
+        tokens = normalize(label)
+        if tokens in self.tokens:
+            return self.tokens[tokens]
+        # Coarse annotations often drop the "cell", e.g. Epithelial, Myeloid
+        return self.tokens.get(tuple(sorted({*tokens, 'cell'})))
+
+    def label(self, term_id: str) -> str:
+        return self.terms[term_id]['label']
+
+    def ancestors(self, term_id: str) -> Iterable[str]:
+        return self.terms[term_id].get('ancestors', {}).keys()
+
+    def rollup(self, term_counts: dict[str, int]) -> dict[str, int]:
+        """Add each term's count to all of its ancestors"""
+        rolled = defaultdict(int)
+        for term_id, count in term_counts.items():
+            rolled[term_id] += count
+            for ancestor in self.ancestors(term_id):
+                if ancestor in self.terms:
+                    rolled[ancestor] += count
+        return dict(rolled)
+
+
+@cache
+def get_cell_ontology_index() -> CellOntologyIndex:
+    """Build the index once per process"""
+    return CellOntologyIndex.from_cellxgene_schema()
+
+
+def cell_type_columns(columns: Iterable[str]) -> list[str]:
+    """
+    Candidate annotation columns, finest level first
+    e.g. [celltype_L3, celltype_L2, celltype_L1]
+    """
+    candidates = []
+    for column in columns:
+        match = CELL_TYPE_COLUMN_PATTERN.match(column)
+        if match:
+            candidates.append((int(match['level'] or 0), column))
+    return [column for _, column in sorted(candidates, reverse=True)]
+
+
+def harmonize_obs(obs: pd.DataFrame, columns: list[str],
+                  index: CellOntologyIndex) -> tuple[dict[str, int], dict[str, int]]:
+    """
+    Map cells to CL terms using the finest annotation level that resolves
+
+    Counts unique combinations of the annotation columns, so the cost
+    scales with the number of distinct labels, not cells.
+    Return: counts by CL label (unresolved as "unknown"), counts by CL term id
+    """
+    combinations = obs.groupby(columns, observed=True, dropna=False).size()
+    if len(columns) == 1:
+        combinations.index = [(value,) for value in combinations.index]
+
+    labels = defaultdict(int)
+    terms = defaultdict(int)
+    for values, count in combinations.items():
+        term_id = next(
+            (t for v in values if not pd.isna(v) and (t := index.resolve(str(v)))),
+            None)
+        if term_id is None:
+            labels[UNKNOWN] += int(count)
+        else:
+            labels[index.label(term_id)] += int(count)
+            terms[term_id] += int(count)
+    return dict(labels), dict(terms)
@@ -24,8 +24,9 @@ a heatmap/table for all datasets
 
 For datasets that have a cell_type annotation, expose the cell_type proportions
 as-is to the database record upload.
-For datasets without a cell_type annotation...it won't have any cell_types to
-make available.
+For datasets without a cell_type annotation, harmonize any
+`celltype_L1/L2/L3`-style annotations to Cell Ontology terms,
+see cell_ontology.py. Otherwise it won't have any cell_types to make available.
 
 For the final table in the frontend, we should add together 
 all unique cell_types along the Y-axis
@@ -39,59 +40,149 @@ For each dataset
 """
 import os
 import argparse
-import anndata as ad
 import json
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from collections import defaultdict
-from typing import List, TypeAlias
+from typing import TYPE_CHECKING, Annotated, List, TypeAlias
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from pydantic import BaseModel, TypeAdapter
-import pandas as pd
+from pydantic import BaseModel, Field, TypeAdapter
 
+# anndata, pandas, h5py/zarr (via src.remote) & the Cell Ontology are
+# imported where they are used, so the CLI starts quickly
+from scripts.utils import RemoteURI, fingerprint_files, is_remote
 
-from scripts.utils import get_files
+if TYPE_CHECKING:
+    import pandas as pd
 
 load_dotenv()
-        
-# Setup sqlalchemy connection
-engine: str = create_engine(os.environ.get('SUPABASE_URI'))
-print(engine)
+
+
+def get_engine():
+    """Setup sqlalchemy connection, only needed when uploading"""
+    from sqlalchemy import create_engine
+
+    engine = create_engine(os.environ.get('SUPABASE_URI'))
+    print(engine)
+    return engine
+
 
 class CellProportion(BaseModel):
-    file: Path
+    file: Annotated[RemoteURI | Path, Field(union_mode='left_to_right')]
     cell_types: dict = {}
+    fingerprint: str | None = None
+    harmonized_from: Annotated[List[str], "Annotation columns mapped to CL terms"] = []
+    ontology_counts: Annotated[dict, "Counts by CL term id, rolled up to ancestors"] = {}
 
 CellProportionList: TypeAlias = list[CellProportion]
 CellProportionListModel = TypeAdapter(CellProportionList)
 
 
-def sum_cell_types(cell_proportions: List[CellProportion]) -> dict:
-    # Compile total
+def sum_cell_types(cell_proportions: List[CellProportion], field: str = 'cell_types') -> dict:
+    # Compile total, counting datasets published under several groups once
     all_cell_types = defaultdict(int)
+    seen = set()
     for c in cell_proportions:
-        for cell_type, count in c.cell_types.items():
+        if c.fingerprint is not None:
+            if c.fingerprint in seen:
+                continue
+            seen.add(c.fingerprint)
+        for cell_type, count in getattr(c, field).items():
             all_cell_types[cell_type] += count
     return all_cell_types
 
 
-def process_files(files, groups: List[str] = []):
+def count_cell_types(f: Path, fingerprint: str | None = None,
+                     harmonize: bool = True) -> CellProportion:
+    """
+    Count cells per cell_type
+    If harmonize, datasets without a cell_type annotation are mapped to CL
+    terms from their other annotation columns, and counts are rolled up
+    the ontology hierarchy into ontology_counts
+    """
+    import anndata as ad
+
+    if is_remote(f):
+        return count_remote_cell_types(f, fingerprint, harmonize)
+
+    adata = ad.read_h5ad(f, backed='r')
+    return count_obs_cell_types(f, adata.obs, fingerprint, harmonize)
+
+
+def count_remote_cell_types(uri: str, fingerprint: str | None = None,
+                            harmonize: bool = True) -> CellProportion:
+    """Read only the annotation columns of a remote dataset, see remote.py"""
+    from scripts.cell_ontology import cell_type_columns
+    from src.remote import obs_columns, open_anndata, read_obs_columns
+
+    with open_anndata(uri) as group:
+        columns = obs_columns(group)
+        if 'cell_type' in columns:
+            columns = ['cell_type']
+        elif harmonize:
+            columns = cell_type_columns(columns)
+        else:
+            columns = []
+        obs = read_obs_columns(group, columns)
+    return count_obs_cell_types(uri, obs, fingerprint, harmonize)
+
+
+def count_obs_cell_types(f: Path | str, obs: 'pd.DataFrame', fingerprint: str | None = None,
+                         harmonize: bool = True) -> CellProportion:
+    from scripts.cell_ontology import cell_type_columns, get_cell_ontology_index, harmonize_obs
+
+    try:
+        cell_types = obs['cell_type'].value_counts().to_dict()
+        c = CellProportion(file=f, cell_types=cell_types, fingerprint=fingerprint)
+        if harmonize:
+            index = get_cell_ontology_index()
+            terms = defaultdict(int)
+            for cell_type, count in cell_types.items():
+                term_id = index.resolve(str(cell_type))
+                if term_id is not None:
+                    terms[term_id] += count
+            c.ontology_counts = index.rollup(terms)
+        print(c)
+    except KeyError as e:
+        print(f"Dataset: {f}")
+        print(f"Caught KeyError: {e}")
+        c = CellProportion(file=f, fingerprint=fingerprint)
+        columns = cell_type_columns(obs.columns)
+        if harmonize and columns:
+            print(f"Harmonizing {columns} to Cell Ontology terms")
+            index = get_cell_ontology_index()
+            cell_types, terms = harmonize_obs(obs, columns, index)
+            c.cell_types = cell_types
+            c.harmonized_from = columns
+            c.ontology_counts = index.rollup(terms)
+    return c
+
+
+def load_groups(groups_file: str | Path) -> List[str]:
+    with open(groups_file, 'r') as f:
+        return [line.strip() for line in f.readlines()]
+
+
+def process_files(files, groups: List[str] = [], harmonize: bool = True):
     cell_proportions = []
+    fingerprints = fingerprint_files(files)
+    counted = {}
     for f in files:
-        adata = ad.read_h5ad(f, backed=True)
-        try:
-            cell_types = adata.obs['cell_type'].value_counts().to_dict()
-            c = CellProportion(file=f, cell_types=cell_types) 
-            print(c)
-        except KeyError as e:
-            print(f"Dataset: {f}")
-            print(f"Caught KeyError: {e}")
-            c = CellProportion(file=f)
-        finally:
-            cell_proportions.append(c)
+        fingerprint = fingerprints[f]
+        if fingerprint in counted:
+            # Duplicate dataset, reuse the counts of the first copy
+            print(f"Dataset: {f} duplicates {counted[fingerprint].file}")
+            c = counted[fingerprint].model_copy(update={'file': f})
+        else:
+            c = count_cell_types(f, fingerprint, harmonize)
+            counted[fingerprint] = c
+        cell_proportions.append(c)
+
+    write_cell_proportions(cell_proportions, groups)
 
 
+def write_cell_proportions(cell_proportions: List[CellProportion], groups: List[str] = []):
+    """Dump cell_types.json & cell_proportions.json, summing groups together"""
     # Sum all cell_types
     # Dump cell_type totals
     all_cell_types = sum_cell_types(cell_proportions)
@@ -107,7 +198,10 @@ def process_files(files, groups: List[str] = []):
         current_group_sum = sum_cell_types(current_group)
         print(current_group_sum)
         print()
-        group_cp = CellProportion(file=Path(g), cell_types=current_group_sum)
+        group_cp = CellProportion(
+            file=Path(g),
+            cell_types=current_group_sum,
+            ontology_counts=sum_cell_types(current_group, field='ontology_counts'))
         print(group_cp)
         groups_to_add.append(group_cp)
 
@@ -127,50 +221,69 @@ def process_files(files, groups: List[str] = []):
         f.write(CellProportionListModel.dump_json(cell_proportions))
 
 
+def cell_type_counts(cell_types: dict, cell_proportions: List[CellProportion]) -> dict[str, List[int]]:
+    """cell_type -> count in each dataset, in cell_proportions order"""
+    return {
+        cell_type: [dataset.cell_types.get(cell_type, 0) for dataset in cell_proportions]
+        for cell_type in cell_types
+    }
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument("--input", "-i", help="input files")
-    parser.add_argument("--groups", "-g", help="Add these cell_type counts together")
-    parser.add_argument("--transform", "-t", action="store_true", help="input files")
-    args = parser.parse_args()
 
-    if args.transform:
-        # Skip processing, just read in cell_types.json & cell_proportions.json
-        with open('cell_types.json', 'r') as f:
-            cell_types = json.load(f)
+def dataset_names(cell_proportions: List[CellProportion]) -> List[str]:
+    return [PurePosixPath(str(dataset.file)).stem for dataset in cell_proportions]
 
-        with open('cell_proportions.json', 'r') as f:
-            cell_proportions: List[CellProportion] = CellProportionListModel.validate_python(json.load(f))
-        
-        datasets = [dataset.file.stem for dataset in cell_proportions]
-        cell_type_dataset_array = defaultdict(list)
-        for cell_type, count in cell_types.items():
-            # print(f"{cell_type} => {count}")
-            for dataset in cell_proportions:
-                cell_type_count = dataset.cell_types.get(cell_type, 0)
-                cell_type_dataset_array[cell_type].append(cell_type_count)
 
-        for k, v in cell_type_dataset_array.items():
-            print(f"{k} => {v}")
-            print(len(v))
+def cell_type_counts_frame(cell_types: dict, cell_proportions: List[CellProportion]) -> 'pd.DataFrame':
+    """Table of cell_type x dataset counts, as uploaded to cell_type_counts"""
+    import pandas as pd
 
+    cell_type_dataset_array = cell_type_counts(cell_types, cell_proportions)
+    for k, v in cell_type_dataset_array.items():
+        print(f"{k} => {v}")
+        print(len(v))
 
+    # Create a pandas dataframe
+    data = cell_type_dataset_array.values()
+    return pd.DataFrame(data, index=cell_type_dataset_array.keys(),
+                        columns=dataset_names(cell_proportions))
 
-        # Create a pandas dataframe
-        data = cell_type_dataset_array.values()
-        df = pd.DataFrame(data, index=cell_type_dataset_array.keys(), columns=datasets)
-        print(df)
-        print(df.to_sql(name='cell_type_counts', con=engine, if_exists='replace'))
 
+def upload_cell_type_counts(cell_types_file: str = 'cell_types.json',
+                            cell_proportions_file: str = 'cell_proportions.json',
+                            dry_run: bool = False):
+    """
+    Replace the cell_type_counts table with cell_type x dataset counts
+    dry_run prints the table as tab separated text, pandas is only
+    imported for the upload
+    """
+    # Skip processing, just read in cell_types.json & cell_proportions.json
+    with open(cell_types_file, 'r') as f:
+        cell_types = json.load(f)
 
-    else:
-        files = get_files(args.input, ('*.h5ad',))
-        if args.groups:
-            with open(args.groups, 'r') as f:
-                groups = [line.strip() for line in f.readlines()]
+    with open(cell_proportions_file, 'r') as f:
+        cell_proportions: List[CellProportion] = CellProportionListModel.validate_python(json.load(f))
 
-            process_files(files, groups)
-        else:
-            process_files(files)
+    if dry_run:
+        print('\t'.join(['', *dataset_names(cell_proportions)]))
+        for cell_type, counts in cell_type_counts(cell_types, cell_proportions).items():
+            print('\t'.join([cell_type, *map(str, counts)]))
+        return
+
+    df = cell_type_counts_frame(cell_types, cell_proportions)
+    print(df)
+    print(df.to_sql(name='cell_type_counts', con=get_engine(), if_exists='replace'))
+
+
+if __name__ == "__main__":
+    from scripts.cli import add_proportions_arguments, run_proportions
 
+    parser = argparse.ArgumentParser(description="")
+    add_proportions_arguments(parser)
+    parser.add_argument("--transform", "-t", action="store_true", help="input files")
+    args = parser.parse_args()
+
+    if args.transform:
+        upload_cell_type_counts()
+
+    else:
+        run_proportions(args)
@@ -0,0 +1,258 @@
+"""
+Command line arguments & entry points for main.py and the scripts.
+
+Only the standard library is imported here. Each run_* function imports
+the modules it needs (anndata, pandas, sqlalchemy, supabase, ...) when it
+runs, and database clients are only created by runs that upload, so
+`--help` and dry runs start in milliseconds.
+"""
+import argparse
+import logging
+import os
+
+LOG_LEVELS = {
+    'critical': logging.CRITICAL,
+    'error': logging.ERROR,
+    'warn': logging.WARNING,
+    'warning': logging.WARNING,
+    'info': logging.INFO,
+    'debug': logging.DEBUG,
+}
+
+
+def add_extract_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--input", "-i", required=True,
+                        help="Location of h5ad files, a directory or e.g. s3://bucket/prefix")
+    parser.add_argument("--output", "-o", default='output.json')
+    parser.add_argument("--extra-metadata", "-em",
+                        help="Provide a file containing extra metadata for the dataset. WIP")
+    parser.add_argument("--group", "-g", action="store_true",
+                        help="Group h5ad files by directory")
+    parser.add_argument("--add-invalid-data-example", action="store_true",
+                        help="Adds an example containing an error list")
+    parser.add_argument("--validate", action="store_true",
+                        help="Validate files against the cellxgene schema")
+    parser.add_argument("--validation-cache", default='.validation_cache.json',
+                        help="Cache of validation results keyed by file fingerprint")
+    parser.add_argument("--validation-timeout", type=int, default=600,
+                        help="Per-file validation timeout in seconds")
+    parser.add_argument("--workers", "-w", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running, updating outputs as files change")
+    parser.add_argument("--groups-file", "-gf",
+                        help="Watch mode: cell_type counts to add together, see celltype_proportions.py")
+    parser.add_argument("--upload", action="store_true",
+                        help="Watch mode: upload changes to the database")
+    parser.add_argument("--debounce", type=float, default=2.0,
+                        help="Watch mode: seconds a file must stay unchanged before processing")
+    parser.add_argument("--gene-index",
+                        help="Watch mode: keep this gene index database up to date, see gene_index.py")
+    parser.add_argument("--polling", action="store_true",
+                        help="Watch mode: poll instead of using inotify")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="List the files that would be extracted")
+    parser.add_argument("--log-level", "-log",
+                        default='info',
+                        choices=['debug', 'info', 'warning'],
+                        help="Provide the log level")
+
+
+def add_proportions_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--input", "-i", help="input files, a directory or e.g. s3://bucket/prefix")
+    parser.add_argument("--groups", "-g", help="Add these cell_type counts together")
+    parser.add_argument("--no-harmonize", action="store_true",
+                        help="Skip mapping cell type annotations to Cell Ontology terms")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="List the files that would be counted")
+
+
+def add_transform_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--cell-types", default='cell_types.json')
+    parser.add_argument("--cell-proportions", default='cell_proportions.json')
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the cell_type_counts table, skip the database upload")
+
+
+def add_upload_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--input-file", "-i", required=True,
+        help="Datasets metadata records to insert into the datasets table")
+    parser.add_argument("--dry-run", action="store_true", help="Skip database insert")
+
+
+def add_convert_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--input", "-i", help="Input h5ad file", required=True)
+    parser.add_argument("--output", "-o", help="Output zarr file")
+
+
+def add_subsample_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--input", "-i", required=True,
+                        help="Location of h5ad files, a directory or e.g. s3://bucket/prefix")
+    parser.add_argument("--output-dir", "-o", default='previews')
+    parser.add_argument("--format", choices=['zarr', 'h5ad'], default='zarr')
+    parser.add_argument("--n-cells", "-n", type=int, default=50_000,
+                        help="Cells per preview")
+    parser.add_argument("--column", default='cell_type', help="Stratify by this obs column")
+    parser.add_argument("--min-per-type", type=int, default=10,
+                        help="Cells kept per stratum, when available")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", "-w", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="List the files that would be subsampled")
+
+
+def add_index_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--input", "-i", help="Location of h5ad files to index")
+    parser.add_argument("--database", "-d", default='gene_index.sqlite')
+    parser.add_argument("--query", "-q", nargs='*', default=[],
+                        help="Gene identifiers to look up")
+    parser.add_argument("--workers", "-w", type=int)
+
+
+def add_rechunk_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--input", "-i", help="Input h5ad file", required=True)
+    parser.add_argument("--output", "-o", help="Output zarr file")
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024,
+                        help="Entries per zarr chunk")
+    parser.add_argument("--memory-limit", type=int, default=1024 ** 3,
+                        help="Approximate bytes held in memory during the transpose")
+    parser.add_argument("--spill-dir", help="Directory for temporary spill files")
+
+
+def list_files(path: str):
+    from scripts.utils import EXTENSIONS, get_files
+
+    files = get_files(path, EXTENSIONS)
+    for f in files:
+        print(f)
+    print(f"{len(files)} files")
+
+
+def run_extract(args: argparse.Namespace):
+    if args.dry_run:
+        list_files(args.input)
+        return
+
+    from scripts import extract_adata_metadata as extract
+
+    extract.logger.setLevel(LOG_LEVELS.get(args.log_level, logging.INFO))
+    if args.watch:
+        from scripts.celltype_proportions import load_groups
+        from scripts.gene_index import GeneIndex
+        from scripts.watch import DatasetIndex, watch_datasets
+        from scripts.watch import logger as watch_logger
+        watch_logger.setLevel(LOG_LEVELS.get(args.log_level, logging.INFO))
+        index = DatasetIndex(
+            output=args.output,
+            groups=load_groups(args.groups_file) if args.groups_file else [],
+            upload=args.upload,
+            workers=args.workers,
+            gene_index=GeneIndex(args.gene_index) if args.gene_index else None)
+        watch_datasets(args.input, extract.EXTENSIONS, index,
+                       debounce=args.debounce, polling=args.polling)
+    else:
+        extract.main(args)
+
+
+def run_proportions(args: argparse.Namespace):
+    if args.dry_run:
+        list_files(args.input)
+        return
+
+    from scripts.celltype_proportions import load_groups, process_files
+    from scripts.utils import get_files
+
+    files = get_files(args.input, ('*.h5ad',))
+    groups = load_groups(args.groups) if args.groups else []
+    process_files(files, groups, harmonize=not args.no_harmonize)
+
+
+def run_transform(args: argparse.Namespace):
+    from scripts.celltype_proportions import upload_cell_type_counts
+
+    upload_cell_type_counts(args.cell_types, args.cell_proportions, dry_run=args.dry_run)
+
+
+def run_upload(args: argparse.Namespace):
+    # Only imports the Supabase SDK when inserting
+    from scripts.import_metadata_to_supabase import main
+
+    main(args)
+
+
+def run_subsample(args: argparse.Namespace):
+    if args.dry_run:
+        list_files(args.input)
+        return
+
+    from scripts.subsample import subsample_datasets
+    from scripts.utils import EXTENSIONS, get_files
+
+    subsample_datasets(
+        get_files(args.input, EXTENSIONS), args.output_dir, suffix=f".{args.format}",
+        workers=args.workers, root=args.input, n_cells=args.n_cells, column=args.column,
+        min_per_type=args.min_per_type, seed=args.seed)
+
+
+def run_index(args: argparse.Namespace):
+    from scripts.extract_adata_metadata import extract_files_metadata
+    from scripts.gene_index import GeneIndex
+    from scripts.utils import EXTENSIONS, get_files
+
+    with GeneIndex(args.database) as index:
+        if args.input:
+            files = extract_files_metadata(get_files(args.input, EXTENSIONS), workers=args.workers)
+            print(f"Removed {len(index.prune(files))} datasets")
+            print(f"Indexed {len(index.update(files, workers=args.workers))} datasets")
+        for gene in args.query:
+            for filepath, position in index.lookup(gene):
+                print(f"{gene}\t{filepath}\t{position}")
+
+
+def run_rechunk(args: argparse.Namespace):
+    from scripts.rechunk import rechunk_gene_major
+
+    rechunk_gene_major(args.input, args.output, chunk_size=args.chunk_size,
+                       memory_limit=args.memory_limit, spill_dir=args.spill_dir)
+
+
+def run_convert(args: argparse.Namespace):
+    from scripts.utils import convert_h5ad_to_zarr
+
+    convert_h5ad_to_zarr(args.input, args.output)
+
+
+COMMANDS = {
+    'extract': (add_extract_arguments, run_extract,
+                "Extract dataset metadata to a json file (output.json)"),
+    'proportions': (add_proportions_arguments, run_proportions,
+                    "Count cell types (cell_types.json & cell_proportions.json)"),
+    'transform': (add_transform_arguments, run_transform,
+                  "Upload cell_types.json & cell_proportions.json as cell_type_counts"),
+    'upload': (add_upload_arguments, run_upload,
+               "Insert metadata records into the datasets table"),
+    'subsample': (add_subsample_arguments, run_subsample,
+                  "Write stratified subsample previews (previews/*.preview.zarr)"),
+    'index': (add_index_arguments, run_index,
+              "Build/update the gene index (gene_index.sqlite), or query it"),
+    'rechunk': (add_rechunk_arguments, run_rechunk,
+                "Write a gene-major (CSC) zarr copy of X (a.h5ad.genes.zarr)"),
+    'convert': (add_convert_arguments, run_convert,
+                "Convert an h5ad file to zarr"),
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='main.py', description="cancer-cell-portal-utils")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (add_arguments, run, help) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        add_arguments(subparser)
+        subparser.set_defaults(run=run)
+    return parser
+
+
+def main(argv: list[str] | None = None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
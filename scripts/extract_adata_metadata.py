@@ -26,20 +26,25 @@ does not contain the gene ID, an alternative column can be specified
 with --var-names
 """
 import argparse
+import importlib.metadata
 import logging
+import signal
+import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from pathlib import Path
+from functools import cache
+from pathlib import Path, PurePosixPath
 from typing import List, TypeAlias
 
 # 3rd party imports
 import anndata as ad
+import fsspec
 from typing import Annotated
 from pydantic import (
     BaseModel,
     Field,
     computed_field,
-    ByteSize,
     FilePath,
     TypeAdapter,
     ValidationError,
@@ -49,21 +54,13 @@ from pydantic import (
 )
 from pydantic_core import ErrorDetails
 
-from scripts.utils import get_files
+from src.remote import is_remote, obs_columns, open_anndata
+from scripts.utils import EXTENSIONS, RemoteURI, fingerprint_file, get_files
 
 # Ignore all warnings from anndata
 warnings.filterwarnings('ignore', module='anndata')
 
 # Configure logger
-levels = {
-    'critical': logging.CRITICAL,
-    'error': logging.ERROR,
-    'warn': logging.WARNING,
-    'warning': logging.WARNING,
-    'info': logging.INFO,
-    'debug': logging.DEBUG,
-}
-
 formatter = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -74,23 +71,18 @@ logger.addHandler(ConsoleOutputHandler)
 
 
 # Models
-class S3File(BaseModel):
-    name:  str
-    filepath: Annotated[str, "s3 uri"]
-    size: ByteSize
-    created: datetime
-    modified: datetime
-    last_access: datetime
-
-
 class File(BaseModel):
     name: str = ''
-    filepath: FilePath = Path()
+    filepath: Annotated[FilePath | RemoteURI, Field(union_mode='left_to_right')] = Path()
     group: str | None = None
     size: int = 0
     created: float = 0
     modified: float = 0
     last_access: float = 0
+    fingerprint: Annotated[str | None, "Sampled content hash"] = None
+    duplicate_of: Annotated[
+        Annotated[RemoteURI | Path, Field(union_mode='left_to_right')] | None,
+        "First file with the same fingerprint"] = None
 
 
 class AnndataMetadata(BaseModel):
@@ -145,13 +137,47 @@ CombinedDataList: TypeAlias = list[CombinedData]
 CombinedDataListModel = TypeAdapter(CombinedDataList)
 
 
-EXTENSIONS = (
-    '*.h5ad',
-    # '*.zarr'
-)
+class SchemaValidation(BaseModel):
+    """
+    Outcome of a cellxgene-schema validation run against a single file
+    Cached by content fingerprint so unchanged files are not re-validated
+    """
+    fingerprint: str
+    is_valid: bool = False
+    errors: Annotated[List[str], "cellxgene-schema error messages"] = []
+    timed_out: bool = False
+    completed: Annotated[bool, "validate() returned, only completed results are cached"] = False
+    elapsed: Annotated[float, "Seconds spent validating"] = 0
+
 
+SchemaValidationCache: TypeAlias = dict[str, SchemaValidation]
+SchemaValidationCacheModel = TypeAdapter(SchemaValidationCache)
+
+
+def extract_remote_file_metadata(uri: str) -> File:
+    fs, path = fsspec.core.url_to_fs(uri)
+    info = fs.info(path)
+    modified = info.get('LastModified') or info.get('mtime') or info.get('created') or 0
+    if isinstance(modified, datetime):
+        modified = modified.timestamp()
+    # Object stores do not track creation/access times
+    file = File(
+        filepath=uri,
+        name=PurePosixPath(path).name,
+        group=PurePosixPath(path).parent.name,
+        size=info['size'],
+        created=modified,
+        modified=modified,
+        last_access=modified,
+        fingerprint=fingerprint_file(uri)
+    )
+    logger.debug(file.model_dump_json())
+    return file
 
-def extract_file_metadata(f: Path) -> File:
+
+def extract_file_metadata(f: Path | str) -> File:
+    if is_remote(f):
+        return extract_remote_file_metadata(f)
     stats = f.stat()
     file = File(
         filepath=f,
@@ -160,25 +186,62 @@ def extract_file_metadata(f: Path) -> File:
         size=stats.st_size,
         created=stats.st_ctime,
         modified=stats.st_mtime,
-        last_access=stats.st_atime
+        last_access=stats.st_atime,
+        fingerprint=fingerprint_file(f)
     )
     logger.debug(file.model_dump_json())
     return file
 
 
-def extract_h5ad_metadata(f: Path, group: bool = False, backed: bool = False) -> AnndataMetadata:
+def extract_files_metadata(files: List[Path | str], workers: int | None = None) -> List[File]:
+    """
+    Extract file metadata, including fingerprints, concurrently
+    Files sharing a fingerprint are flagged with duplicate_of
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        all_files = list(executor.map(extract_file_metadata, files))
+    flag_duplicates(all_files)
+    return all_files
+
+
+def flag_duplicates(files: List[File]) -> dict[str, List[File]]:
+    """
+    Point duplicate_of at the first file seen with the same fingerprint
+    Return: fingerprint -> files, for fingerprints seen more than once
     """
-    Given: a File in a Path like object
+    seen = {}
+    for file in files:
+        if file.fingerprint is None:
+            continue
+        seen.setdefault(file.fingerprint, []).append(file)
+    duplicates = {k: v for k, v in seen.items() if len(v) > 1}
+    for original, *copies in duplicates.values():
+        for copy in copies:
+            copy.duplicate_of = original.filepath
+            logger.info(f"Duplicate dataset: {copy.filepath} == {original.filepath}")
+    return duplicates
+
+
+def extract_h5ad_metadata(f: Path | str, group: bool = False, backed: bool = False) -> AnndataMetadata:
+    """
+    Given: a File in a Path like object, or a remote URI
     Return: AnndataMetadata instance
 
+    Remote files are read with range requests, see remote.py
+
     Note:
     If there are validation errors during the instantiation step
     then ValidationError will be raised and the pydantic model
     will not be instantiated.
 
     """
+    if is_remote(f):
+        with open_anndata(f) as group:
+            return extract_group_metadata(group)
+
     # Log, Applying & Validating Against Model
-    data = ad.read_h5ad(f, backed=backed)
+    # Read-only, r+ (backed=True) would touch the mtime of every file read
+    data = ad.read_h5ad(f, backed='r' if backed else None)
     # print(data)
     # print(data.obs_keys())
     # print(data.obs['tissue'])
@@ -200,28 +263,219 @@ def extract_h5ad_metadata(f: Path, group: bool = False, backed: bool = False) ->
         raise exc
 
 
+def extract_group_metadata(group) -> AnndataMetadata:
+    """
+    Given: an h5py.File/zarr.Group in the AnnData on-disk format
+    Return: AnndataMetadata instance, read from attributes only
+    """
+    X = group.get('X')
+    if X is None:
+        shape = (len(group['obs'][group['obs'].attrs['_index']]),
+                 len(group['var'][group['var'].attrs['_index']]))
+    elif 'shape' in X.attrs:
+        # Sparse matrices are groups of data, indices & indptr
+        shape = tuple(int(n) for n in X.attrs['shape'])
+    else:
+        shape = tuple(X.shape)
+    return AnndataMetadata(
+        is_backed=True,
+        n_obs=shape[0],
+        n_vars=shape[1],
+        shape=shape,
+        obs=obs_columns(group),
+        obsm=list(group.get('obsm', {}).keys()),
+        var=list(group['var'].attrs.get('column-order', [])),
+        uns=list(group.get('uns', {}).keys()),
+        layers=list(group.get('layers', {}).keys())
+    )
+
+
 # Marked for utils
 
 
-def process_files(files: List[Path]) -> List[CombinedData]:
+class ValidationTimeout(BaseException):
+    """
+    Raised by SIGALRM. Not an Exception, cellxgene-schema wraps some checks
+    in `except Exception` and would record a timeout as a validation error
+    """
+
+
+def run_schema_validation(f: Path, fingerprint: str, timeout: int) -> SchemaValidation:
+    """
+    Validate a single file against the cellxgene schema
+    Runs inside a worker process, SIGALRM enforces the per-file timeout.
+
+    cellxgene-schema raises on some non-compliant files (e.g. missing
+    required obs columns) instead of reporting them, those exceptions are
+    recorded as errors, but not cached as they may be transient. A run the
+    alarm fired during is never completed, even if validate() swallowed
+    the ValidationTimeout and returned.
+    """
+    from cellxgene_schema.validate import validate
+
+    fired = False
+
+    def raise_timeout(signum, frame):
+        nonlocal fired
+        fired = True
+        raise ValidationTimeout
+
+    start = time.monotonic()
+    result = SchemaValidation(fingerprint=fingerprint)
+    if timeout and hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.alarm(timeout)
+    try:
+        is_valid, errors, _ = validate(f)
+        result.is_valid = is_valid
+        result.errors = [str(e) for e in errors]
+        result.completed = True
+    except ValidationTimeout:
+        pass
+    except Exception as exc:
+        result.errors = [f"Validation failed: {exc!r}"]
+    finally:
+        if timeout and hasattr(signal, 'SIGALRM'):
+            signal.alarm(0)
+    if fired:
+        result.is_valid = False
+        result.timed_out = True
+        result.completed = False
+        result.errors = [f"Validation timed out after {timeout}s"]
+    result.elapsed = time.monotonic() - start
+    return result
+
+
+@cache
+def schema_version() -> str:
+    return importlib.metadata.version('cellxgene-schema')
+
+
+def validation_cache_key(fingerprint: str) -> str:
+    """Results are only reused by the cellxgene-schema version that produced them"""
+    return f"{schema_version()}:{fingerprint}"
+
+
+def load_validation_cache(cache_path: Path) -> SchemaValidationCache:
+    if not cache_path.exists():
+        return {}
+    try:
+        return SchemaValidationCacheModel.validate_json(cache_path.read_bytes())
+    except ValidationError:
+        logger.warning(f"Ignoring unreadable validation cache: {cache_path}")
+        return {}
+
+
+def save_validation_cache(cache_path: Path, cache: SchemaValidationCache):
+    with open(cache_path, 'wb') as fh:
+        fh.write(SchemaValidationCacheModel.dump_json(cache))
+
+
+def validate_files(
+        files: List[File],
+        cache_path: Path | None = None,
+        workers: int | None = None,
+        timeout: int = 600) -> dict[Path, SchemaValidation]:
+    """
+    Run cellxgene-schema validation over files in a process pool
+
+    Results are cached by content fingerprint in cache_path, only files
+    missing from the cache are validated, and duplicates are validated
+    once. Cache keys include the cellxgene-schema version, and only
+    results where validate() returned are cached, so timeouts and
+    failures are retried on the next run.
+    """
+    cache = load_validation_cache(cache_path) if cache_path else {}
+    remote = [file.filepath for file in files if is_remote(file.filepath)]
+    if remote:
+        # cellxgene-schema loads the whole file, defeating range requests
+        logger.warning(f"Skipping validation of {len(remote)} remote files")
+    fingerprints = {
+        file.filepath: file.fingerprint or fingerprint_file(file.filepath)
+        for file in files if not is_remote(file.filepath)
+    }
+    results = {}
+    pending = {}
+    for f, fingerprint in fingerprints.items():
+        if validation_cache_key(fingerprint) in cache:
+            logger.debug(f"Validation cache hit: {f}")
+            results[f] = cache[validation_cache_key(fingerprint)]
+        else:
+            pending.setdefault(fingerprint, f)
+    logger.info(f"Validating {len(pending)} files ({len(results)} cached)")
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                f: executor.submit(run_schema_validation, f, fingerprint, timeout)
+                for fingerprint, f in pending.items()
+            }
+            for f, future in futures.items():
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    # Worker died, e.g. killed by the OOM killer
+                    result = SchemaValidation(
+                        fingerprint=fingerprints[f],
+                        errors=[f"Validation failed: {exc!r}"])
+                logger.info(f"Validated {f}: is_valid={result.is_valid} ({result.elapsed:.1f}s)")
+                results[f] = result
+                # Timeouts, dead workers & exceptions are retried on the next run
+                if result.completed:
+                    cache[validation_cache_key(result.fingerprint)] = result
+
+        # Duplicates share their original's result
+        for f, fingerprint in fingerprints.items():
+            if f not in results:
+                results[f] = results[pending[fingerprint]]
+
+    if cache_path:
+        save_validation_cache(cache_path, cache)
+    return results
+
+
+def schema_errors(f: Path, result: SchemaValidation) -> List[ErrorDetails]:
+    """Convert a SchemaValidation into pydantic style error entries"""
+    error_type = 'cellxgene_schema_timeout' if result.timed_out else 'cellxgene_schema'
+    return [
+        ErrorDetails(type=error_type, loc=('cellxgene_schema',), msg=msg, input=str(f))
+        for msg in result.errors
+    ]
+
+
+def process_files(
+        files: List[File],
+        validations: dict[Path, SchemaValidation] | None = None) -> List[CombinedData]:
     """
-    1. Extract file metadata
-    2. Extract anndata metadata
+    Given: File metadata, see extract_files_metadata
+    1. Extract anndata metadata
         If ValidationErrors,
           return empty initialized AnndataMetadata
           and populated list of errors
         If no ValidationErrors,
           return the populated AnndataMetadata
           and empty list of errors
+        Duplicates reuse the anndata metadata of their original
+    2. Append cellxgene-schema errors, if validation results are given
     """
+    validations = validations or {}
     all_metadata = []
-    for f in files:
-        logger.info(f"Extracting metadata: {f}")
-        combined = CombinedData(file=extract_file_metadata(f))
-        try:
-            combined.metadata = extract_h5ad_metadata(f, group=args.group, backed=True)
-        except ValidationError as exc:
-            combined.errors = exc.errors()
+    originals = {}
+    for file in files:
+        f = file.filepath
+        combined = CombinedData(file=file)
+        if file.duplicate_of in originals:
+            logger.info(f"Reusing metadata of {file.duplicate_of}: {f}")
+            combined.metadata, combined.errors = originals[file.duplicate_of]
+        else:
+            logger.info(f"Extracting metadata: {f}")
+            try:
+                combined.metadata = extract_h5ad_metadata(f, backed=True)
+            except ValidationError as exc:
+                combined.errors = exc.errors()
+            originals[f] = (combined.metadata, combined.errors)
+        if f in validations:
+            combined.errors = combined.errors + schema_errors(f, validations[f])
         all_metadata.append(combined)
     return all_metadata
 
@@ -253,9 +507,21 @@ def main(args):
     files = get_files(path=args.input, extensions=EXTENSIONS)
     logger.info(f"Collected {len(files)} files")
 
+    # Extract file metadata & flag duplicate datasets
+    files = extract_files_metadata(files, workers=args.workers)
+
+    # Validate against the cellxgene schema
+    validations = None
+    if args.validate:
+        validations = validate_files(
+            files,
+            cache_path=Path(args.validation_cache),
+            workers=args.workers,
+            timeout=args.validation_timeout)
+
     # Process Files
     # all_metadata = process_files(files[0:1])
-    all_metadata = process_files(files)
+    all_metadata = process_files(files, validations)
 
     # Example empty/default initialized AnndataMetadata
     if args.add_invalid_data_example:
@@ -273,24 +539,11 @@ def main(args):
 
 
 if __name__ == "__main__":
+    from scripts.cli import add_extract_arguments, run_extract
+
     parser = argparse.ArgumentParser(description="")
-    parser.add_argument("--input", "-i", required=True,
-                        help="Location of h5ad files")
-    parser.add_argument("--output", "-o", default='output.json')
-    parser.add_argument("--extra-metadata", "-em",
-                        help="Provide a file containing extra metadata for the dataset. WIP")
-    parser.add_argument("--group", "-g", action="store_true",
-                        help="Group h5ad files by directory")
-    parser.add_argument("--add-invalid-data-example", action="store_true",
-                        help="Adds an example containing an error list")
-    parser.add_argument("--log-level", "-log",
-                        default='info',
-                        choices=['debug', 'info', 'warning'],
-                        help="Provide the log level")
-    args = parser.parse_args()
-    logger.setLevel(levels.get(args.log_level, logging.INFO))
-
-    main(args)
+    add_extract_arguments(parser)
+    run_extract(parser.parse_args())
 
     """
     Supabase record to insert
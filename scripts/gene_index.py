@@ -0,0 +1,165 @@
+"""
+Cross-dataset gene index: which datasets measure gene X, and at which
+var position.
+
+AnndataMetadata.var only stores the var column names, so answering this
+used to mean opening every file. The index reads each dataset's
+var/_index once and stores an inverted index in SQLite:
+
+* genes - gene identifier (e.g. Ensembl ID) -> integer id
+* datasets - file path & fingerprint of each indexed dataset
+* gene_positions - (gene id, dataset id, var position), clustered by gene
+  id so a lookup is a single index range scan, with a secondary index on
+  dataset id so re-indexing or removing a dataset does not scan the table
+
+Datasets are only re-read when their fingerprint changes, see
+extract_adata_metadata.extract_files_metadata.
+"""
+import argparse
+import os
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, List
+
+import numpy as np
+from anndata.io import read_elem
+
+from scripts.extract_adata_metadata import File
+from scripts.utils import open_store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS genes (
+    id INTEGER PRIMARY KEY,
+    gene TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    id INTEGER PRIMARY KEY,
+    filepath TEXT NOT NULL UNIQUE,
+    fingerprint TEXT,
+    n_vars INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS gene_positions (
+    gene_id INTEGER NOT NULL,
+    dataset_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (gene_id, dataset_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS gene_positions_dataset ON gene_positions(dataset_id);
+"""
+
+
+def read_var_names(f: Path | str) -> np.ndarray:
+    """Read only var/_index of an AnnData store"""
+    with open_store(f) as group:
+        var = group['var']
+        return np.asarray(read_elem(var[var.attrs['_index']]), dtype=str)
+
+
+def iter_var_names(files: List[Path | str], workers: int | None = None) -> Iterator[np.ndarray]:
+    """
+    read_var_names of each file, in order
+    At most 2 reads per worker are in flight or waiting to be consumed, so
+    var names are not all held in memory while the index is written
+    """
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for f in files:
+            pending.append(executor.submit(read_var_names, f))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class GeneIndex:
+
+    def __init__(self, path: str | Path = 'gene_index.sqlite'):
+        self.path = Path(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fingerprints(self) -> dict[str, str]:
+        return dict(self.db.execute('SELECT filepath, fingerprint FROM datasets'))
+
+    def update(self, files: List[File], workers: int | None = None) -> List[Path | str]:
+        """
+        (Re-)index files whose fingerprint changed since they were indexed
+        Return: the files that were (re-)indexed
+        """
+        stored = self.fingerprints()
+        changed = [
+            file for file in files
+            if file.fingerprint is None or stored.get(str(file.filepath)) != file.fingerprint
+        ]
+        # var/_index reads are I/O bound, writes go through one connection
+        all_var_names = iter_var_names([file.filepath for file in changed], workers)
+        gene_ids = dict(self.db.execute('SELECT gene, id FROM genes'))
+        for file, var_names in zip(changed, all_var_names):
+            with self.db:
+                self._remove(str(file.filepath))
+                dataset_id = self.db.execute(
+                    'INSERT INTO datasets (filepath, fingerprint, n_vars) VALUES (?, ?, ?)',
+                    (str(file.filepath), file.fingerprint, len(var_names))).lastrowid
+                new_genes = [gene for gene in dict.fromkeys(var_names) if gene not in gene_ids]
+                next_id = max(gene_ids.values(), default=0) + 1
+                for i, gene in enumerate(new_genes):
+                    gene_ids[gene] = next_id + i
+                self.db.executemany(
+                    'INSERT INTO genes (id, gene) VALUES (?, ?)',
+                    ((gene_ids[gene], gene) for gene in new_genes))
+                self.db.executemany(
+                    'INSERT INTO gene_positions (gene_id, dataset_id, position) VALUES (?, ?, ?)',
+                    ((gene_ids[gene], dataset_id, position)
+                     for position, gene in enumerate(var_names)))
+        return [file.filepath for file in changed]
+
+    def _remove(self, filepath: str):
+        dataset_id = self.db.execute(
+            'SELECT id FROM datasets WHERE filepath = ?', (filepath,)).fetchone()
+        if dataset_id is not None:
+            self.db.execute('DELETE FROM gene_positions WHERE dataset_id = ?', dataset_id)
+            self.db.execute('DELETE FROM datasets WHERE id = ?', dataset_id)
+
+    def remove(self, filepaths: Iterable[Path | str]):
+        with self.db:
+            for filepath in filepaths:
+                self._remove(str(filepath))
+
+    def prune(self, files: List[File]) -> List[str]:
+        """Remove datasets that are no longer present in files"""
+        current = {str(file.filepath) for file in files}
+        removed = [f for f in self.fingerprints() if f not in current]
+        self.remove(removed)
+        return removed
+
+    def lookup(self, gene: str) -> List[tuple[str, int]]:
+        """Return: (dataset filepath, var position) of every dataset measuring gene"""
+        return self.db.execute(
+            'SELECT d.filepath, p.position FROM genes g '
+            'JOIN gene_positions p ON p.gene_id = g.id '
+            'JOIN datasets d ON d.id = p.dataset_id '
+            'WHERE g.gene = ? ORDER BY d.filepath, p.position', (gene,)).fetchall()
+
+    def datasets_with_gene(self, gene: str) -> List[str]:
+        return list(dict.fromkeys(filepath for filepath, _ in self.lookup(gene)))
+
+
+if __name__ == "__main__":
+    from scripts.cli import add_index_arguments, run_index
+
+    parser = argparse.ArgumentParser(
+            description="Build/update the cross-dataset gene index, or query it")
+    add_index_arguments(parser)
+    run_index(parser.parse_args())
@@ -1,28 +1,60 @@
 import os
 import argparse
 import json
+from functools import cache
 
 # 3rd Party imports
 from dotenv import load_dotenv
-from supabase import create_client, Client
 
 load_dotenv()
 
-# Setup the Supabase client
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
+
+@cache
+def get_client():
+    """Setup the Supabase client, only when talking to the database"""
+    from supabase import create_client, Client
+
+    url: str = os.environ.get("SUPABASE_URL")
+    key: str = os.environ.get("SUPABASE_KEY")
+    supabase: Client = create_client(url, key)
+    return supabase
 
 
 def select_datasets():
     response = (
-        supabase.table("datasets")
+        get_client().table("datasets")
         .select("*")
         .execute()
     )
     print(response)
 
 
+def insert_datasets(data: list):
+    response = (
+        get_client().table("datasets")
+        .insert(data)
+        .execute()
+    )
+    print(response)
+
+
+def delete_datasets(filepaths: list):
+    """Delete the records of datasets, matched by file.filepath"""
+    response = (
+        get_client().table("datasets")
+        .delete()
+        .in_("file->>filepath", filepaths)
+        .execute()
+    )
+    print(response)
+
+
+def upsert_datasets(data: list):
+    """Replace the records of re-extracted datasets, insert new ones"""
+    delete_datasets([record['file']['filepath'] for record in data])
+    insert_datasets(data)
+
+
 def main(args):
     # Read the records file
     with open(args.input_file) as fh:
@@ -33,20 +65,15 @@ def main(args):
     if args.dry_run:
         print(f"{len(data)} Records to insert")
     else:
-        response = (
-            supabase.table("datasets")
-            .insert(data)
-            .execute()
-        )
-        print(response)
+        insert_datasets(data)
 
 
 
 if __name__ == "__main__":
+    from scripts.cli import add_upload_arguments
+
     parser = argparse.ArgumentParser(description="")
-    parser.add_argument("--input-file", "-i", required=True, 
-        help="Datasets metadata records to insert into the datasets table")
-    parser.add_argument("--dry-run", help="Skip database insert")
+    add_upload_arguments(parser)
     args = parser.parse_args()
 
     main(args)
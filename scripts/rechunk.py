@@ -0,0 +1,250 @@
+"""
+Write a gene-major (CSC) zarr copy of X for fast per-gene lookups.
+
+Our h5ad files store X row-major (CSR, chunked by cell), so reading the
+expression of one gene across all cells touches the whole matrix. The
+gene-major copy stores X as an AnnData-encoded csc_matrix, where one
+gene's values are a contiguous slice of data/indices, so a lookup only
+touches the chunks overlapping that slice.
+
+The transpose is done out of core with bounded memory:
+1. Count non-zeros per gene, streaming X's indices in row blocks
+2. Split genes into stripes whose non-zeros fit in memory_limit, and
+   spill each row block's entries to per-stripe files on disk
+3. Load one stripe at a time, sort it by gene and write it to the output
+
+X stored as CSC is already gene-major, it is copied in column blocks,
+re-chunked to chunk_size, without a transpose.
+
+Output layout ({file.name}.genes.zarr):
+* X - csc_matrix encoded group of data, indices (cell positions), indptr
+* var_names - gene identifiers, in column order
+"""
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import h5py
+import numpy as np
+import scipy.sparse as sp
+import zarr
+from anndata.io import read_elem
+
+from scripts.utils import open_store
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_MEMORY_LIMIT = 1024 ** 3
+
+
+def matrix_shape(X) -> tuple[int, int]:
+    if 'shape' in X.attrs:
+        return tuple(int(n) for n in X.attrs['shape'])
+    return tuple(X.shape)
+
+
+def iter_row_blocks(X, max_nnz: int) -> Iterator[tuple[int, sp.csr_matrix]]:
+    """Yield (first row, CSR block) with at most ~max_nnz entries per block"""
+    encoding = X.attrs.get('encoding-type', 'array')
+    n_obs, n_vars = matrix_shape(X)
+    if encoding == 'csr_matrix':
+        indptr = X['indptr'][:]
+        start = 0
+        while start < n_obs:
+            # At least one row per block, even if it exceeds max_nnz
+            end = max(int(np.searchsorted(indptr, indptr[start] + max_nnz, side='right')) - 1,
+                      start + 1)
+            end = min(end, n_obs)
+            lo, hi = indptr[start], indptr[end]
+            yield start, sp.csr_matrix(
+                (X['data'][lo:hi], X['indices'][lo:hi], indptr[start:end + 1] - lo),
+                shape=(end - start, n_vars))
+            start = end
+    elif encoding == 'array':
+        rows = max(1, max_nnz // max(n_vars, 1))
+        for start in range(0, n_obs, rows):
+            yield start, sp.csr_matrix(X[start:start + rows])
+    else:
+        raise NotImplementedError(f"Unsupported X encoding: {encoding}")
+
+
+def copy_columns(X, indptr: np.ndarray, data, indices, max_nnz: int):
+    """Copy a csc_matrix X to data/indices in column blocks of ~max_nnz entries"""
+    n_obs, n_vars = matrix_shape(X)
+    column = 0
+    while column < n_vars:
+        # At least one column per block, even if it exceeds max_nnz
+        end = max(int(np.searchsorted(indptr, indptr[column] + max_nnz, side='right')) - 1,
+                  column + 1)
+        end = min(end, n_vars)
+        lo, hi = int(indptr[column]), int(indptr[end])
+        block = sp.csc_matrix(
+            (X['data'][lo:hi], X['indices'][lo:hi], indptr[column:end + 1] - lo),
+            shape=(n_obs, end - column))
+        # Rows ascending within a gene, as for transposed input
+        block.sort_indices()
+        data[lo:hi] = block.data
+        indices[lo:hi] = block.indices
+        column = end
+
+
+def count_genes(X, max_nnz: int) -> np.ndarray:
+    """Non-zeros per gene"""
+    n_vars = matrix_shape(X)[1]
+    counts = np.zeros(n_vars, dtype=np.int64)
+    if X.attrs.get('encoding-type') == 'csr_matrix':
+        # Only the column indices are needed
+        indices = X['indices']
+        for start in range(0, indices.shape[0], max_nnz):
+            counts += np.bincount(indices[start:start + max_nnz], minlength=n_vars)
+        return counts
+    for _, block in iter_row_blocks(X, max_nnz):
+        counts += np.bincount(block.indices, minlength=n_vars)
+    return counts
+
+
+def assign_stripes(counts: np.ndarray, max_nnz: int) -> np.ndarray:
+    """Stripe number per gene, each stripe of contiguous genes holds <= max_nnz entries"""
+    stripes = np.empty(len(counts), dtype=np.int64)
+    stripe = 0
+    total = 0
+    for gene, count in enumerate(counts):
+        if total and total + count > max_nnz:
+            stripe += 1
+            total = 0
+        stripes[gene] = stripe
+        total += count
+    return stripes
+
+
+def rechunk_gene_major(
+        fpath: str | Path,
+        output: str | Path | None = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        memory_limit: int = DEFAULT_MEMORY_LIMIT,
+        spill_dir: str | Path | None = None) -> Path:
+    """
+    Write a gene-major zarr copy of fpath's X, see module docstring
+
+    chunk_size: entries per zarr chunk of X/data & X/indices
+    memory_limit: approximate bytes of entries held in memory at once
+    spill_dir: where to spill stripes, defaults to the system temp dir
+    """
+    output = Path(output or f"{Path(str(fpath)).name}.genes.zarr")
+    with open_store(fpath) as f:
+        X = f['X']
+        n_obs, n_vars = matrix_shape(X)
+        dtype = X['data'].dtype if isinstance(X, (h5py.Group, zarr.Group)) else X.dtype
+        index_dtype = np.int32 if n_obs < np.iinfo(np.int32).max else np.int64
+        # data + row + column of each entry, twice for sorting temporaries
+        entry_size = dtype.itemsize + 2 * np.dtype(index_dtype).itemsize
+        max_nnz = max(1, memory_limit // (2 * entry_size))
+
+        gene_major = X.attrs.get('encoding-type') == 'csc_matrix'
+        if gene_major:
+            indptr = X['indptr'][:].astype(np.int64)
+        else:
+            counts = count_genes(X, max_nnz)
+            indptr = np.concatenate([[0], np.cumsum(counts)])
+            stripes = assign_stripes(counts, max_nnz)
+            n_stripes = int(stripes[-1]) + 1 if n_vars else 0
+
+        out = zarr.open_group(str(output), mode='w')
+        out.attrs['source'] = str(fpath)
+        group = out.create_group('X')
+        group.attrs.update({
+            'encoding-type': 'csc_matrix',
+            'encoding-version': '0.1.0',
+            'shape': [n_obs, n_vars],
+        })
+        group.array('indptr', indptr, chunks=(len(indptr),))
+        data = group.zeros('data', shape=(int(indptr[-1]),),
+                           chunks=(chunk_size,), dtype=dtype)
+        indices = group.zeros('indices', shape=(int(indptr[-1]),),
+                              chunks=(chunk_size,), dtype=index_dtype)
+        var = f['var']
+        out.array('var_names', np.asarray(read_elem(var[var.attrs['_index']]), dtype=str))
+
+        if gene_major:
+            copy_columns(X, indptr, data, indices, max_nnz)
+            return output
+
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+            spill = Path(tmp)
+
+            # Spill each row block's entries to their stripe's files
+            for start, block in iter_row_blocks(X, max_nnz):
+                block = block.tocoo()
+                block_stripes = stripes[block.col]
+                order = np.argsort(block_stripes, kind='stable')
+                bounds = np.concatenate(
+                    [[0], np.cumsum(np.bincount(block_stripes, minlength=n_stripes))])
+                rows = (block.row[order] + start).astype(index_dtype)
+                cols = block.col[order].astype(np.int64)
+                values = block.data[order].astype(dtype)
+                for stripe in np.flatnonzero(np.diff(bounds)):
+                    lo, hi = bounds[stripe], bounds[stripe + 1]
+                    for name, array in (('rows', rows), ('cols', cols), ('data', values)):
+                        with open(spill / f"{stripe}.{name}", 'ab') as fh:
+                            array[lo:hi].tofile(fh)
+
+            # Sort each stripe by gene, rows stay ascending within a gene
+            for stripe in range(n_stripes):
+                if not (spill / f"{stripe}.cols").exists():
+                    continue
+                cols = np.fromfile(spill / f"{stripe}.cols", dtype=np.int64)
+                order = np.argsort(cols, kind='stable')
+                offset = int(indptr[cols[order[0]]])
+                rows = np.fromfile(spill / f"{stripe}.rows", dtype=index_dtype)
+                values = np.fromfile(spill / f"{stripe}.data", dtype=dtype)
+                indices[offset:offset + len(order)] = rows[order]
+                data[offset:offset + len(order)] = values[order]
+                for name in ('rows', 'cols', 'data'):
+                    (spill / f"{stripe}.{name}").unlink()
+    return output
+
+
+class GeneMajorStore:
+    """Read single genes from a gene-major copy, see rechunk_gene_major"""
+
+    def __init__(self, path: str | Path):
+        self.group = zarr.open_group(str(path), mode='r')
+        self.X = self.group['X']
+        self.shape = tuple(self.X.attrs['shape'])
+        self.indptr = self.X['indptr'][:]
+        self._var_names = None
+
+    @property
+    def var_names(self) -> dict[str, int]:
+        if self._var_names is None:
+            self._var_names = {
+                name: i for i, name in enumerate(self.group['var_names'][:])
+            }
+        return self._var_names
+
+    def gene_position(self, gene: str | int) -> int:
+        if isinstance(gene, (int, np.integer)):
+            return int(gene)
+        return self.var_names[gene]
+
+    def read_gene_sparse(self, gene: str | int) -> tuple[np.ndarray, np.ndarray]:
+        """Return: (cell positions, values) of a gene's non-zero entries"""
+        position = self.gene_position(gene)
+        lo, hi = self.indptr[position], self.indptr[position + 1]
+        return self.X['indices'][lo:hi], self.X['data'][lo:hi]
+
+    def read_gene(self, gene: str | int) -> np.ndarray:
+        """Return: a gene's dense expression across all cells"""
+        cells, values = self.read_gene_sparse(gene)
+        column = np.zeros(self.shape[0], dtype=values.dtype)
+        column[cells] = values
+        return column
+
+
+if __name__ == "__main__":
+    from scripts.cli import add_rechunk_arguments, run_rechunk
+
+    parser = argparse.ArgumentParser(
+            description="Write a gene-major (CSC) zarr copy of an h5ad file's X")
+    add_rechunk_arguments(parser)
+    run_rechunk(parser.parse_args())
@@ -0,0 +1,339 @@
+"""
+Stratified subsample previews: a small (~50k cells) representative subset
+of each dataset for the portal, stratified by cell_type.
+
+Only the parts needed are read:
+1. Rows are picked from obs/cell_type's categorical codes, not the labels
+2. X, layers & obsm are read for the selected rows only. Rows are sorted
+   and grouped into chunk-aligned reads, each chunk is read once and
+   neighbouring rows of sparse matrices share a read of data/indices
+3. obs & var are read as dataframes, uns and obsp/varp are dropped
+
+Output: {dataset stem}.preview.zarr (or .h5ad) per dataset, mirroring the
+dataset's directory under the input root, so datasets with the same name in
+different groups do not collide. The selection is recorded in
+uns['preview']. Duplicate datasets (same fingerprint) are only subsampled
+once.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Annotated, Iterator, List
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import zarr
+from anndata.io import read_elem
+from pydantic import BaseModel
+
+from scripts.extract_adata_metadata import extract_files_metadata
+from scripts.rechunk import matrix_shape
+from scripts.utils import open_store
+
+DEFAULT_N_CELLS = 50_000
+DEFAULT_MIN_PER_TYPE = 10
+# Rows/entries per read when a dataset is not chunked, e.g. contiguous HDF5
+BLOCK_BYTES = 16 * 1024 ** 2
+
+
+class Preview(BaseModel):
+    """Outcome of subsampling a single dataset"""
+    source: str
+    output: str | None = None
+    n_obs: Annotated[int, "Cells in the source dataset"] = 0
+    n_sampled: int = 0
+    column: str = 'cell_type'
+    cell_types: Annotated[dict[str, int], "Sampled cells per stratum"] = {}
+    elapsed: Annotated[float, "Seconds spent subsampling"] = 0
+    duplicate_of: Annotated[str | None, "Not subsampled, same fingerprint as this dataset"] = None
+    error: str | None = None
+
+
+def read_codes(obs, column: str = 'cell_type') -> tuple[np.ndarray, list[str]]:
+    """
+    Stratum of each cell & the stratum labels, from categorical codes
+    Missing values (code -1) are a stratum of their own, the last one
+    """
+    if column not in obs:
+        return np.zeros(dataframe_length(obs), dtype=np.int64), ['all']
+    elem = obs[column]
+    if isinstance(elem, (h5py.Group, zarr.Group)) and 'codes' in elem:
+        codes = elem['codes'][:].astype(np.int64)
+        categories = [str(c) for c in read_elem(elem['categories'])]
+    else:
+        # Not categorical, e.g. a string array
+        categories, codes = np.unique(np.asarray(read_elem(elem), dtype=str), return_inverse=True)
+        categories = list(categories)
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(categories), codes)
+        categories.append('nan')
+    return codes, categories
+
+
+def dataframe_length(elem) -> int:
+    return elem[elem.attrs['_index']].shape[0]
+
+
+def allocate(counts: np.ndarray, n: int, min_per_type: int = DEFAULT_MIN_PER_TYPE) -> np.ndarray:
+    """
+    Cells to sample per stratum, summing to n
+    Each stratum gets min(count, min_per_type) cells, unless that exceeds n,
+    the rest is split proportionally to the remaining cells by largest remainder
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    if counts.sum() <= n:
+        return counts.copy()
+    allocation = np.minimum(counts, min_per_type)
+    if allocation.sum() > n:
+        allocation = np.zeros_like(counts)
+    spare = counts - allocation
+    budget = n - allocation.sum()
+    share = budget * spare / spare.sum()
+    extra = np.floor(share).astype(np.int64)
+    leftover = budget - extra.sum()
+    extra[np.argsort(extra - share, kind='stable')[:leftover]] += 1
+    return allocation + extra
+
+
+def stratified_rows(codes: np.ndarray, n: int, min_per_type: int = DEFAULT_MIN_PER_TYPE,
+                    seed: int = 0) -> np.ndarray:
+    """Sorted row positions of a stratified sample of n cells"""
+    counts = np.bincount(codes)
+    allocation = allocate(counts, n, min_per_type)
+    rng = np.random.default_rng(seed)
+    by_stratum = np.split(np.argsort(codes, kind='stable'), np.cumsum(counts)[:-1])
+    rows = [
+        rng.choice(stratum_rows, size=k, replace=False)
+        for stratum_rows, k in zip(by_stratum, allocation) if k
+    ]
+    return np.sort(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+
+
+def block_length(array, item_bytes: int) -> int:
+    """Items along the first axis per chunk-aligned read"""
+    if array.chunks:
+        return array.chunks[0]
+    return max(1, BLOCK_BYTES // max(item_bytes, 1))
+
+
+def iter_spans(starts: np.ndarray, stops: np.ndarray, gap: int,
+               max_span: int) -> Iterator[tuple[int, int, slice]]:
+    """
+    Coalesce sorted [start, stop) ranges into reads of (lo, hi, ranges)
+    Ranges closer than gap share a read, as they would re-read the same chunk
+    """
+    first = 0
+    for i in range(1, len(starts) + 1):
+        if (i == len(starts)
+                or starts[i] - stops[i - 1] >= gap
+                or stops[i] - starts[first] > max_span):
+            yield int(starts[first]), int(stops[i - 1]), slice(first, i)
+            first = i
+
+
+def read_dense_rows(array, rows: np.ndarray) -> np.ndarray:
+    """Selected rows of a dense array, reading each chunk along rows once"""
+    row_bytes = int(np.prod(array.shape[1:], dtype=np.int64)) * array.dtype.itemsize
+    length = block_length(array, row_bytes)
+    out = np.empty((len(rows), *array.shape[1:]), dtype=array.dtype)
+    blocks = rows // length
+    bounds = np.flatnonzero(np.diff(blocks)) + 1
+    for selected in np.split(np.arange(len(rows)), bounds):
+        if not len(selected):
+            continue
+        lo = int(blocks[selected[0]]) * length
+        block = array[lo:min(lo + length, array.shape[0])]
+        out[selected] = block[rows[selected] - lo]
+    return out
+
+
+def read_csr_rows(group, rows: np.ndarray) -> sp.csr_matrix:
+    """Selected rows of a csr_matrix group, coalescing reads of data/indices"""
+    n_vars = matrix_shape(group)[1]
+    data, indices = group['data'], group['indices']
+    indptr = group['indptr'][:]
+    starts, stops = indptr[rows], indptr[rows + 1]
+    item_bytes = data.dtype.itemsize + indices.dtype.itemsize
+    length = block_length(data, item_bytes)
+    max_span = max(length, BLOCK_BYTES // item_bytes)
+
+    out_data = np.empty(int((stops - starts).sum()), dtype=data.dtype)
+    out_indices = np.empty(len(out_data), dtype=indices.dtype)
+    out_indptr = np.concatenate([[0], np.cumsum(stops - starts)])
+    for lo, hi, selected in iter_spans(starts, stops, length, max_span):
+        span_data, span_indices = data[lo:hi], indices[lo:hi]
+        for start, stop, position in zip(starts[selected], stops[selected],
+                                         out_indptr[selected]):
+            out_data[position:position + stop - start] = span_data[start - lo:stop - lo]
+            out_indices[position:position + stop - start] = span_indices[start - lo:stop - lo]
+    return sp.csr_matrix((out_data, out_indices, out_indptr), shape=(len(rows), n_vars))
+
+
+def read_csc_rows(group, rows: np.ndarray) -> sp.csc_matrix:
+    """Selected rows of a csc_matrix group, streaming column blocks"""
+    n_obs, n_vars = matrix_shape(group)
+    data, indices = group['data'], group['indices']
+    indptr = group['indptr'][:]
+    item_bytes = data.dtype.itemsize + indices.dtype.itemsize
+    max_span = max(block_length(data, item_bytes), BLOCK_BYTES // item_bytes)
+
+    blocks = []
+    column = 0
+    while column < n_vars:
+        end = max(int(np.searchsorted(indptr, indptr[column] + max_span, side='right')) - 1,
+                  column + 1)
+        end = min(end, n_vars)
+        lo, hi = int(indptr[column]), int(indptr[end])
+        block = sp.csc_matrix(
+            (data[lo:hi], indices[lo:hi], indptr[column:end + 1] - lo),
+            shape=(n_obs, end - column))
+        blocks.append(block[rows])
+        column = end
+    if not blocks:
+        return sp.csc_matrix((len(rows), n_vars), dtype=data.dtype)
+    return sp.hstack(blocks, format='csc')
+
+
+def read_rows(elem, rows: np.ndarray):
+    """Selected rows of an AnnData encoded element"""
+    encoding = elem.attrs.get('encoding-type', 'array')
+    if encoding == 'csr_matrix':
+        return read_csr_rows(elem, rows)
+    if encoding == 'csc_matrix':
+        return read_csc_rows(elem, rows)
+    if not isinstance(elem, (h5py.Group, zarr.Group)):
+        return read_dense_rows(elem, rows)
+    # e.g. dataframes in obsm, small compared to X
+    value = read_elem(elem)
+    return value.iloc[rows] if isinstance(value, pd.DataFrame) else value[rows]
+
+
+def read_mapping_rows(group, key: str, rows: np.ndarray) -> dict:
+    if key not in group:
+        return {}
+    return {name: read_rows(elem, rows) for name, elem in group[key].items()}
+
+
+def subsample_dataset(
+        fpath: str | Path,
+        output: str | Path | None = None,
+        n_cells: int = DEFAULT_N_CELLS,
+        column: str = 'cell_type',
+        min_per_type: int = DEFAULT_MIN_PER_TYPE,
+        seed: int = 0) -> Preview:
+    """
+    Write a stratified subsample of fpath, see module docstring
+    output: .zarr or .h5ad path, defaults to {stem}.preview.zarr
+    """
+    start = time.time()
+    name = Path(str(fpath)).name
+    output = Path(output or f"{name.rsplit('.', 1)[0]}.preview.zarr")
+    with open_store(fpath) as f:
+        codes, categories = read_codes(f['obs'], column)
+        rows = stratified_rows(codes, n_cells, min_per_type, seed)
+        obs = read_elem(f['obs']).iloc[rows]
+        sampled = np.bincount(codes[rows], minlength=len(categories))
+        preview = ad.AnnData(
+            X=read_rows(f['X'], rows) if 'X' in f else None,
+            obs=obs,
+            var=read_elem(f['var']),
+            layers=read_mapping_rows(f, 'layers', rows),
+            obsm=read_mapping_rows(f, 'obsm', rows),
+            varm={k: read_elem(v) for k, v in f['varm'].items()} if 'varm' in f else {},
+            uns={'preview': {
+                'source': str(fpath),
+                'n_obs': len(codes),
+                'column': column,
+                'seed': seed,
+            }},
+        )
+    if output.suffix == '.h5ad':
+        preview.write_h5ad(output, compression='gzip')
+    else:
+        preview.write_zarr(output)
+    return Preview(
+        source=str(fpath),
+        output=str(output),
+        n_obs=len(codes),
+        n_sampled=len(rows),
+        column=column,
+        cell_types={c: int(k) for c, k in zip(categories, sampled) if k},
+        elapsed=time.time() - start,
+    )
+
+
+def preview_paths(files: List[Path | str], suffix: str = '.zarr',
+                  root: str | Path | None = None) -> List[PurePosixPath]:
+    """
+    Preview path of each file, relative to the output directory
+    Mirrors the file's path under root, by default the files' common
+    directory, e.g. htan/a.h5ad -> htan/a.preview.zarr
+    """
+    paths = [PurePosixPath(str(f)) for f in files]
+    if root is None:
+        root = os.path.commonpath([p.parent for p in paths]) if paths else ''
+    root = PurePosixPath(str(root))
+    previews = []
+    for path in paths:
+        relative = path.relative_to(root) if path.is_relative_to(root) else PurePosixPath(path.name)
+        previews.append(relative.with_name(f"{relative.name.rsplit('.', 1)[0]}.preview{suffix}"))
+    return previews
+
+
+def subsample_datasets(
+        files: List[Path | str],
+        output_dir: str | Path = 'previews',
+        suffix: str = '.zarr',
+        workers: int | None = None,
+        root: str | Path | None = None,
+        **kwargs) -> List[Preview]:
+    """
+    Subsample datasets in a process pool, see subsample_dataset
+    Previews are written under output_dir, see preview_paths, duplicates
+    of a dataset are skipped
+    """
+    output_dir = Path(output_dir)
+    outputs = dict(zip(files, preview_paths(files, suffix, root)))
+    duplicates = {
+        file.filepath: str(file.duplicate_of)
+        for file in extract_files_metadata(files, workers=workers)
+        if file.duplicate_of is not None
+    }
+    previews = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for f in files:
+            if f in duplicates:
+                continue
+            output = output_dir / outputs[f]
+            output.parent.mkdir(parents=True, exist_ok=True)
+            futures[f] = executor.submit(subsample_dataset, f, output, **kwargs)
+        for f in files:
+            if f in duplicates:
+                preview = Preview(source=str(f), duplicate_of=duplicates[f])
+                print(f"{f}: duplicate of {preview.duplicate_of}, skipped")
+                previews.append(preview)
+                continue
+            try:
+                preview = futures[f].result()
+            except Exception as exc:
+                # Unreadable file or worker died, e.g. killed by the OOM killer
+                preview = Preview(source=str(f), error=repr(exc))
+            print(f"{f}: {preview.n_sampled}/{preview.n_obs} cells "
+                  f"({preview.elapsed:.1f}s){' ' + preview.error if preview.error else ''}")
+            previews.append(preview)
+    return previews
+
+
+if __name__ == "__main__":
+    from scripts.cli import add_subsample_arguments, run_subsample
+
+    parser = argparse.ArgumentParser(
+            description="Write stratified subsample previews of h5ad/zarr datasets")
+    add_subsample_arguments(parser)
+    run_subsample(parser.parse_args())
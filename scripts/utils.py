@@ -1,17 +1,98 @@
+"""
+Shared helpers. Kept free of heavy imports (anndata, h5py, zarr, fsspec,
+pydantic), those are imported where they are used, so file discovery and
+the CLI start quickly.
+"""
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Annotated, List
 
-import anndata as ad
+import xxhash
 
-def get_files(path: str, extensions: tuple) -> List[Path]:
-    """Given a string path, Returns the desired file extensions"""
+from src.stores import is_remote, open_store
+
+EXTENSIONS = (
+    '*.h5ad',
+    # '*.zarr'
+)
+
+# Fingerprint sampling parameters
+FINGERPRINT_HEADER_SIZE = 1024 * 1024
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+FINGERPRINT_SAMPLES = 8
+
+def check_remote_uri(uri: str) -> str:
+    if not is_remote(uri):
+        raise ValueError(f"Not a remote URI: {uri}")
+    return uri
+
+
+class RemoteURIValidator:
+    """
+    Validates RemoteURI fields, like pydantic's AfterValidator(check_remote_uri),
+    pydantic is only imported once a model using RemoteURI is built
+    """
+
+    def __get_pydantic_core_schema__(self, source, handler):
+        from pydantic_core import core_schema
+
+        return core_schema.no_info_after_validator_function(check_remote_uri, handler(source))
+
+
+RemoteURI = Annotated[str, RemoteURIValidator()]
+
+
+def get_files(path: str, extensions: tuple) -> List[Path | str]:
+    """
+    Given a string path, Returns the desired file extensions
+    Remote paths (e.g. s3://bucket/prefix) return URIs instead of Paths
+    """
     all_files = []
+    if is_remote(path):
+        import fsspec
+        fs, root = fsspec.core.url_to_fs(path)
+        for ext in extensions:
+            all_files.extend(
+                fs.unstrip_protocol(f) for f in sorted(fs.glob(f"{root.rstrip('/')}/**/{ext}")))
+        return all_files
     for ext in extensions:
         all_files.extend(Path(path).rglob(ext, recurse_symlinks=True))
     return all_files
 
-def convert_h5ad_to_zarr(fpath: str | Path):
+def fingerprint_file(fpath: str | Path) -> str:
+    """
+    Return a content fingerprint for a file without reading all of it.
+    Hashes the file size, the header and a few evenly spaced blocks, so
+    identical files map to the same fingerprint regardless of path/mtime.
+    Remote files are read with range requests.
+    """
+    from src.remote import open_remote
+
+    fh = open_remote(str(fpath)) if is_remote(fpath) else open(fpath, 'rb')
+    with fh:
+        size = fh.seek(0, 2)
+        fh.seek(0)
+        digest = xxhash.xxh3_128(str(size).encode())
+        digest.update(fh.read(FINGERPRINT_HEADER_SIZE))
+        if size > FINGERPRINT_HEADER_SIZE:
+            step = (size - FINGERPRINT_HEADER_SIZE) // FINGERPRINT_SAMPLES
+            for i in range(1, FINGERPRINT_SAMPLES + 1):
+                fh.seek(min(FINGERPRINT_HEADER_SIZE + i * step,
+                            size - FINGERPRINT_BLOCK_SIZE))
+                digest.update(fh.read(FINGERPRINT_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def fingerprint_files(files: List[Path], workers: int | None = None) -> dict[Path, str]:
+    """Fingerprint files concurrently, reads are I/O bound so threads suffice"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(files, executor.map(fingerprint_file, files)))
+
+
+def convert_h5ad_to_zarr(fpath: str | Path, output: str | Path | None = None):
+    import anndata as ad
+
     # Read in h5ad file
     if isinstance(fpath, str):
         file = Path(fpath)
@@ -20,7 +101,7 @@ def convert_h5ad_to_zarr(fpath: str | Path):
     h5ad = ad.read_h5ad(file)
 
     # Write out zarr
-    h5ad.write_zarr(Path(f"{file.name}.output.zarr"))
+    h5ad.write_zarr(Path(output or f"{file.name}.output.zarr"))
 
 def time_convert(atime):
     """Return a datetime object from timestamp"""
@@ -0,0 +1,412 @@
+"""
+Watch a directory of scrnaseq anndata objects and keep the extracted
+outputs up to date as datasets land.
+
+* output.json - metadata, see extract_adata_metadata.py
+* cell_types.json & cell_proportions.json - see celltype_proportions.py
+* .watch_state.json - per-dataset cell type counts, cell_proportions.json
+  sums groups together so it can not be reused after a restart
+
+On Linux, directory changes are picked up with inotify, elsewhere (or if
+inotify is unavailable, e.g. on some network filesystems) the directory
+is polled.
+
+Events are debounced per file, a file is only processed once it has had no
+events and its size & mtime have not changed for a full debounce period,
+so partially copied files are never read, and files that finished landing
+are not held back by others that are still being copied. Only the affected
+files are re-extracted, unchanged files keep their previous results
+(matched by size, mtime & fingerprint). Files that can not be read, e.g.
+truncated copies, are logged in DatasetIndex.errors and retried on their
+next change, the watcher keeps running.
+
+If the inotify event queue overflows, events were lost and the whole tree
+is compared against the index again.
+"""
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Iterable, List
+
+from pydantic import ValidationError
+
+from scripts.celltype_proportions import (
+    CellProportion,
+    CellProportionListModel,
+    count_cell_types,
+    upload_cell_type_counts,
+    write_cell_proportions
+)
+from scripts.extract_adata_metadata import (
+    CombinedData,
+    CombinedDataListModel,
+    File,
+    extract_file_metadata,
+    flag_duplicates,
+    formatter,
+    process_files
+)
+from scripts.gene_index import GeneIndex
+from scripts.utils import get_files
+
+logger = logging.getLogger(__name__)
+ConsoleOutputHandler = logging.StreamHandler()
+ConsoleOutputHandler.setFormatter(formatter)
+logger.addHandler(ConsoleOutputHandler)
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def file_signature(f: Path) -> tuple[int, float] | None:
+    """(size, mtime) of a file, None if it no longer exists"""
+    try:
+        stats = f.stat()
+    except FileNotFoundError:
+        return None
+    return stats.st_size, stats.st_mtime
+
+
+def try_extract_file_metadata(f: Path) -> File | OSError:
+    """extract_file_metadata, returning the error of unreadable files"""
+    try:
+        return extract_file_metadata(f)
+    except OSError as exc:
+        return exc
+
+
+def matches(f: Path, extensions: tuple) -> bool:
+    return any(fnmatch(f.name, ext) for ext in extensions)
+
+
+class EventsLost(Exception):
+    """The inotify event queue overflowed, changes may have been missed"""
+
+
+class PollingWatcher:
+    """Detect changes by comparing (size, mtime) snapshots of the directory"""
+
+    def __init__(self, path: str | Path, extensions: tuple, interval: float = 5.0):
+        self.path = path
+        self.extensions = extensions
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self) -> dict[Path, tuple[int, float] | None]:
+        return {f: file_signature(f) for f in get_files(self.path, self.extensions)}
+
+    def read_events(self, timeout: float | None = None) -> set[Path]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        previous, self.snapshot = self.snapshot, self.scan()
+        return {
+            f for f in previous.keys() | self.snapshot.keys()
+            if previous.get(f) != self.snapshot.get(f)
+        }
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Recursively watch a directory tree with inotify(7)"""
+
+    def __init__(self, path: str | Path):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.path = Path(path)
+        self.directories: dict[int, Path] = {}
+        self.watch_new_directories()
+
+    def watch_new_directories(self):
+        watched = set(self.directories.values())
+        for directory in [self.path, *(p for p in self.path.rglob('*') if p.is_dir())]:
+            if directory not in watched:
+                self.add_watch(directory)
+
+    def add_watch(self, directory: Path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(directory))
+        self.directories[wd] = directory
+
+    def read_events(self, timeout: float | None = None) -> set[Path]:
+        """
+        Paths of files changed since the last call
+        Raises EventsLost if the kernel dropped events, after watching any
+        directories created in the meantime
+        """
+        changed = set()
+        overflowed = False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_DELETE_SELF:
+                del self.directories[wd]
+                continue
+
+            f = directory / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # New dataset group, watch it and pick up anything
+                    # written before the watch was added
+                    self.add_watch(f)
+                    changed.update(p for p in f.rglob('*') if p.is_file())
+                continue
+            changed.add(f)
+        if overflowed:
+            self.watch_new_directories()
+            raise EventsLost(str(self.path))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(path: str | Path, extensions: tuple,
+                   poll_interval: float = 5.0, polling: bool = False):
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except OSError as exc:
+            logger.warning(f"inotify unavailable, falling back to polling: {exc}")
+    return PollingWatcher(path, extensions, poll_interval)
+
+
+class DatasetIndex:
+    """
+    Per-file extraction results, rendered to output.json,
+    cell_types.json & cell_proportions.json after every update
+    """
+
+    def __init__(self, output: str | Path = 'output.json', groups: List[str] = [],
+                 upload: bool = False, workers: int | None = None,
+                 gene_index: GeneIndex | None = None, state: str | Path | None = None):
+        self.output = Path(output)
+        self.state = Path(state) if state else self.output.with_name('.watch_state.json')
+        self.groups = groups
+        self.upload = upload
+        self.workers = workers
+        self.gene_index = gene_index
+        self.metadata: dict[Path, CombinedData] = {}
+        self.proportions: dict[Path, CellProportion] = {}
+        # Files in the previous results that no longer exist
+        self.stale: set[Path] = set()
+        # Files that could not be read, e.g. truncated, until they change again
+        self.errors: dict[Path, str] = {}
+
+    def seed(self):
+        """
+        Load previous results, reused for files whose fingerprint still matches
+        Records of files removed while we were not watching are skipped
+        """
+        if self.output.exists():
+            for record in json.loads(self.output.read_bytes()):
+                try:
+                    combined = CombinedData.model_validate(record)
+                except ValidationError:
+                    filepath = record.get('file', {}).get('filepath')
+                    logger.debug(f"Not reusing stale record of {filepath}")
+                    if filepath:
+                        self.stale.add(Path(filepath))
+                    continue
+                self.metadata[combined.file.filepath] = combined
+        if self.state.exists():
+            for c in CellProportionListModel.validate_json(self.state.read_bytes()):
+                if not Path(c.file).exists():
+                    self.stale.add(Path(c.file))
+                elif c.fingerprint is not None:
+                    self.proportions[Path(c.file)] = c
+
+    def is_current(self, file: File) -> bool:
+        """
+        Previous results are reused if size, mtime & fingerprint match, the
+        fingerprint only samples the file so an in-place edit can miss it
+        """
+        combined = self.metadata.get(file.filepath)
+        proportion = self.proportions.get(file.filepath)
+        return (combined is not None and proportion is not None
+                and combined.file.size == file.size
+                and combined.file.modified == file.modified
+                and combined.file.fingerprint == file.fingerprint == proportion.fingerprint)
+
+    def forget(self, f: Path):
+        self.metadata.pop(f, None)
+        self.proportions.pop(f, None)
+
+    def fail(self, f: Path, exc: Exception):
+        """Drop the results of an unreadable file, retried on its next change"""
+        logger.warning(f"Skipping unreadable file {f}: {exc!r}")
+        self.errors[f] = repr(exc)
+        self.forget(f)
+
+    def update(self, changed: Iterable[Path]) -> List[Path]:
+        """
+        Re-extract changed files & drop removed ones
+        Return: the files that were (re-)extracted
+        """
+        changed = set(changed)
+        removed = {f for f in changed if not f.exists()}
+        for f in removed:
+            logger.info(f"Removed: {f}")
+            self.errors.pop(f, None)
+            self.forget(f)
+
+        paths = sorted(changed - removed)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            extracted = list(executor.map(try_extract_file_metadata, paths))
+        files = []
+        for f, file in zip(paths, extracted):
+            try:
+                if isinstance(file, OSError):
+                    raise file
+                if self.gene_index is not None:
+                    # Has its own fingerprints, e.g. the index may be newer than output.json
+                    self.gene_index.update([file])
+                if self.is_current(file):
+                    continue
+                [combined] = process_files([file])
+                proportion = count_cell_types(f, file.fingerprint)
+            except (OSError, KeyError, ValidationError) as exc:
+                self.fail(f, exc)
+                removed.add(f)
+                continue
+            self.errors.pop(f, None)
+            self.metadata[f] = combined
+            self.proportions[f] = proportion
+            files.append(file)
+        if self.gene_index is not None:
+            self.gene_index.remove(removed)
+
+        if files or removed:
+            self.write()
+            if self.upload:
+                self.upload_changes(files, removed)
+        return [file.filepath for file in files]
+
+    def write(self):
+        all_metadata = [self.metadata[f] for f in sorted(self.metadata)]
+        # Reset duplicate flags, the original may have been removed
+        all_files: List[File] = [combined.file for combined in all_metadata]
+        for file in all_files:
+            file.duplicate_of = None
+        flag_duplicates(all_files)
+
+        with open(self.output, 'wb') as fh:
+            fh.write(CombinedDataListModel.dump_json(all_metadata))
+        all_proportions = [self.proportions[f] for f in sorted(self.proportions)]
+        with open(self.state, 'wb') as fh:
+            fh.write(CellProportionListModel.dump_json(all_proportions))
+        write_cell_proportions(all_proportions, self.groups)
+        logger.info(f"Updated {self.output} with {len(all_metadata)} datasets")
+
+    def upload_changes(self, changed: List[File], removed: Iterable[Path]):
+        """Replace cell_type_counts, upsert changed datasets & delete removed ones"""
+        from scripts.import_metadata_to_supabase import delete_datasets, upsert_datasets
+
+        upload_cell_type_counts()
+        if removed:
+            delete_datasets([str(f) for f in removed])
+        if changed:
+            records = [self.metadata[file.filepath] for file in changed]
+            upsert_datasets(CombinedDataListModel.dump_python(records, mode='json'))
+
+
+def watch_datasets(path: str | Path, extensions: tuple, index: DatasetIndex,
+                   debounce: float = 2.0, poll_interval: float = 5.0,
+                   polling: bool = False, iterations: int | None = None):
+    """
+    Keep index up to date with the files under path, until interrupted
+    or, for testing, after iterations batches have been processed
+    """
+    watcher = create_watcher(path, extensions, poll_interval, polling)
+    # Initial pass picks up anything that changed while we were not watching
+    index.seed()
+    current = set(get_files(path, extensions))
+    index.update(current | index.metadata.keys() | index.proportions.keys() | index.stale)
+    logger.info(f"Watching {path}")
+
+    # (size & mtime, time of the last event) of files waiting to settle
+    pending: dict[Path, tuple[tuple[int, float] | None, float]] = {}
+    try:
+        while iterations is None or iterations > 0:
+            timeout = None
+            if pending:
+                settles = min(last_event for _, last_event in pending.values()) + debounce
+                timeout = max(0, settles - time.monotonic())
+            try:
+                changed = watcher.read_events(timeout=timeout)
+            except EventsLost:
+                logger.warning("Events were lost, rescanning the whole tree")
+                changed = (set(get_files(path, extensions))
+                           | index.metadata.keys() | index.proportions.keys())
+            now = time.monotonic()
+            for f in changed:
+                if matches(f, extensions):
+                    pending[f] = (file_signature(f), now)
+
+            # Process files that have been quiet for a debounce period,
+            # regardless of other files that are still changing
+            ready = []
+            for f, (signature, last_event) in list(pending.items()):
+                if now - last_event < debounce:
+                    continue
+                current_signature = file_signature(f)
+                if current_signature == signature:
+                    ready.append(f)
+                    del pending[f]
+                else:
+                    pending[f] = (current_signature, now)
+            if ready:
+                logger.info(f"Processing {len(ready)} changed files")
+                index.update(ready)
+                if iterations is not None:
+                    iterations -= 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -1,53 +1,228 @@
-from anndata import AnnData, read_h5ad
-from pydantic import BaseModel
+"""
+Storage descriptors of an AnnData store: what each matrix looks like on
+disk, read only from HDF5/zarr attributes and dataset headers.
 
+No array data is read, describing a file takes milliseconds and is used to
+estimate the memory (nbytes) and I/O (stored_bytes, HDF5 only) cost of a
+job before scheduling it.
+"""
+from pathlib import Path
+from typing import Annotated, Dict, Iterator, Literal
+
+import h5py
+import numpy as np
+import zarr
+from pydantic import BaseModel, computed_field
+
+from src.stores import open_store
+
+SPARSE_FORMATS = {'csr_matrix': 'csr', 'csc_matrix': 'csc'}
+# Pre anndata 0.7 h5ad files stored sparse matrices as h5sparse groups
+LEGACY_SPARSE_FORMATS = {'csr': 'csr_matrix', 'csc': 'csc_matrix'}
 
-def extract_layers(ad: AnnData):
-    """
-    Take an anndata object, take all the layers and apply to the adata_class
-    """
-    
-    pass
+
+class Element(BaseModel):
+    """Storage descriptor of a single matrix/dataframe"""
+    encoding_type: Annotated[str, "AnnData encoding-type, e.g. array, csr_matrix"]
+    encoding_version: str | None = None
+    shape: Annotated[tuple[int, ...] | None, "Logical shape"] = None
+    dtype: Annotated[str | None, "dtype of the values, data for sparse matrices"] = None
+    format: Annotated[Literal['dense', 'csr', 'csc'] | None, "Sparse format"] = None
+    nnz: Annotated[int | None, "Stored entries of sparse matrices"] = None
+    chunks: Annotated[tuple[int, ...] | None, "Chunk shape of the values"] = None
+    compression: Annotated[str | None, "Compression of the values, e.g. gzip, blosc:lz4"] = None
+    nbytes: Annotated[int, "Uncompressed size of all arrays, i.e. in memory"] = 0
+    stored_bytes: Annotated[int | None, "Size on disk, HDF5 only, zarr would list every chunk"] = None
+
+
+class Raw(BaseModel):
+    """raw holds the unfiltered X, var & varm"""
+    X: Element | None = None
+    varm: Dict[str, Element] = {}
+    n_vars: int = 0
 
 
 class adata(BaseModel):
     """
-    This is meant to 
+    Storage descriptors of an AnnData store, see extract_layers
 
     AnnData specification (v0.1.0)
     An AnnData object MUST be a group.
 
-    The group’s metadata MUST include entries: 
+    The group’s metadata MUST include entries:
     "encoding-type": "anndata", "encoding-version": "0.1.0".
 
-    An AnnData group MUST contain entries "obs" and "var", 
+    An AnnData group MUST contain entries "obs" and "var",
     which MUST be dataframes (though this may only have an index with no columns).
 
-    The group MAY contain an entry X, which MUST be either a 
+    The group MAY contain an entry X, which MUST be either a
     dense or sparse array and whose shape MUST be (n_obs, n_var)
 
-    The group MAY contain a mapping layers. 
-    Entries in layers MUST be dense or sparse arrays which have 
+    The group MAY contain a mapping layers.
+    Entries in layers MUST be dense or sparse arrays which have
     shapes (n_obs, n_var)
 
-    The group MAY contain a mapping obsm. 
-    Entries in obsm MUST be sparse arrays, dense arrays, or dataframes. 
+    The group MAY contain a mapping obsm.
+    Entries in obsm MUST be sparse arrays, dense arrays, or dataframes.
     These entries MUST have a first dimension of size n_obs
 
-    The group MAY contain a mapping varm. 
-    Entries in varm MUST be sparse arrays, dense arrays, or dataframes. 
+    The group MAY contain a mapping varm.
+    Entries in varm MUST be sparse arrays, dense arrays, or dataframes.
     These entries MUST have a first dimension of size n_var
 
-    The group MAY contain a mapping obsp. 
-    Entries in obsp MUST be sparse or dense arrays. 
+    The group MAY contain a mapping obsp.
+    Entries in obsp MUST be sparse or dense arrays.
     The entries first two dimensions MUST be of size n_obs
 
-    The group MAY contain a mapping varp. 
-    Entries in varp MUST be sparse or dense arrays. 
+    The group MAY contain a mapping varp.
+    Entries in varp MUST be sparse or dense arrays.
     The entries first two dimensions MUST be of size n_var
 
-    The group MAY contain a mapping uns. 
+    The group MAY contain a mapping uns.
     Entries in uns MUST be an anndata encoded type.
     """
     # ['X', 'layers', 'obs', 'obsm', 'obsp', 'uns', 'var', 'varm', 'varp']
-    X: str
+    n_obs: int = 0
+    n_vars: int = 0
+    X: Element | None = None
+    layers: Dict[str, Element] = {}
+    obsm: Dict[str, Element] = {}
+    varm: Dict[str, Element] = {}
+    obsp: Dict[str, Element] = {}
+    varp: Dict[str, Element] = {}
+    raw: Raw | None = None
+
+    @computed_field
+    @property
+    def nbytes(self) -> int:
+        """Memory needed to load every matrix"""
+        elements = [self.X, *self.layers.values(), *self.obsm.values(), *self.varm.values(),
+                    *self.obsp.values(), *self.varp.values()]
+        if self.raw is not None:
+            elements += [self.raw.X, *self.raw.varm.values()]
+        return sum(e.nbytes for e in elements if e is not None)
+
+
+def is_group(elem) -> bool:
+    return isinstance(elem, (h5py.Group, zarr.Group))
+
+
+def iter_arrays(elem) -> Iterator:
+    """All datasets/arrays in elem, recursively"""
+    if is_group(elem):
+        for child in elem.values():
+            yield from iter_arrays(child)
+    else:
+        yield elem
+
+
+def array_nbytes(array) -> int:
+    return int(np.prod(array.shape, dtype=np.int64)) * array.dtype.itemsize
+
+
+def array_compression(array) -> str | None:
+    if isinstance(array, h5py.Dataset):
+        return array.compression
+    codec = array.compressor
+    if codec is None:
+        return None
+    if getattr(codec, 'cname', None):
+        return f"{codec.codec_id}:{codec.cname}"
+    return codec.codec_id
+
+
+def array_stored_bytes(array) -> int | None:
+    if isinstance(array, h5py.Dataset):
+        # From the chunk index, no data is read
+        return array.id.get_storage_size()
+    # zarr has no chunk index, sizing an array means listing/stat-ing every chunk
+    return None
+
+
+def group_stored_bytes(elem) -> int | None:
+    sizes = [array_stored_bytes(array) for array in iter_arrays(elem)]
+    return None if None in sizes else sum(sizes)
+
+
+def dataframe_length(elem) -> int:
+    # Pre anndata 0.7 h5ad files stored dataframes as compound datasets
+    if not is_group(elem):
+        return elem.shape[0]
+    return elem[elem.attrs['_index']].shape[0]
+
+
+def describe_element(elem) -> Element:
+    """Element of a dataset/array or encoded group, without reading its values"""
+    attrs = elem.attrs
+    encoding_type = attrs.get('encoding-type')
+    if encoding_type is None and 'h5sparse_format' in attrs:
+        encoding_type = LEGACY_SPARSE_FORMATS[attrs['h5sparse_format']]
+    encoding_version = attrs.get('encoding-version')
+
+    if not is_group(elem):
+        return Element(
+            encoding_type=encoding_type or 'array',
+            encoding_version=encoding_version,
+            shape=elem.shape,
+            dtype=str(elem.dtype),
+            format='dense',
+            chunks=elem.chunks,
+            compression=array_compression(elem),
+            nbytes=array_nbytes(elem),
+            stored_bytes=array_stored_bytes(elem),
+        )
+
+    arrays = list(iter_arrays(elem))
+    element = Element(
+        encoding_type=encoding_type or 'dict',
+        encoding_version=encoding_version,
+        nbytes=sum(array_nbytes(array) for array in arrays),
+        stored_bytes=group_stored_bytes(elem),
+    )
+    if encoding_type in SPARSE_FORMATS:
+        data = elem['data']
+        shape = attrs['shape'] if 'shape' in attrs else attrs['h5sparse_shape']
+        element.shape = tuple(int(n) for n in shape)
+        element.dtype = str(data.dtype)
+        element.format = SPARSE_FORMATS[encoding_type]
+        element.nnz = data.shape[0]
+        element.chunks = data.chunks
+        element.compression = array_compression(data)
+    elif encoding_type == 'dataframe':
+        element.shape = (dataframe_length(elem), len(attrs.get('column-order', [])))
+    return element
+
+
+def describe_mapping(group, key: str) -> Dict[str, Element]:
+    if key not in group:
+        return {}
+    return {name: describe_element(elem) for name, elem in group[key].items()}
+
+
+def extract_layers(store: str | Path | h5py.Group | zarr.Group) -> adata:
+    """
+    Describe X, layers, obsm/varm/obsp/varp & raw of an h5ad/zarr AnnData
+    store, a path (local or remote) or an open h5py/zarr group
+    """
+    if not is_group(store):
+        with open_store(store) as group:
+            return extract_layers(group)
+
+    raw = None
+    if 'raw' in store:
+        raw = Raw(
+            X=describe_element(store['raw']['X']) if 'X' in store['raw'] else None,
+            varm=describe_mapping(store['raw'], 'varm'),
+            n_vars=dataframe_length(store['raw']['var']),
+        )
+    return adata(
+        n_obs=dataframe_length(store['obs']),
+        n_vars=dataframe_length(store['var']),
+        X=describe_element(store['X']) if 'X' in store else None,
+        layers=describe_mapping(store, 'layers'),
+        obsm=describe_mapping(store, 'obsm'),
+        varm=describe_mapping(store, 'varm'),
+        obsp=describe_mapping(store, 'obsp'),
+        varp=describe_mapping(store, 'varp'),
+        raw=raw,
+    )
@@ -0,0 +1,302 @@
+"""
+Read remote (e.g. s3://) h5ad/zarr datasets through fsspec, fetching only
+the byte ranges that are actually read.
+
+Fetched ranges are stored as fixed-size blocks in an on-disk LRU cache, so
+rescanning a bucket re-uses previously read HDF5 metadata/zarr chunks
+instead of downloading whole files. Blocks are keyed by the object's
+ETag (or size & mtime), a changed object never serves stale blocks.
+
+Storage options (endpoint, credentials) come from the usual fsspec/botocore
+configuration, e.g. AWS_ENDPOINT_URL or fsspec.config.conf['s3'].
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import fsspec
+import h5py
+import pandas as pd
+import zarr
+from anndata.io import read_elem
+
+from src.stores import is_remote
+
+DEFAULT_CACHE_DIR = Path(os.environ.get(
+    'CCP_BLOCK_CACHE_DIR',
+    Path.home() / '.cache' / 'cancer-cell-portal-utils' / 'blocks'))
+DEFAULT_CACHE_SIZE = 10 * 1024 ** 3
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# HDF5 superblock & root object headers live at the start of the file
+PREFETCH_BLOCKS = 8
+PREFETCH_WORKERS = 8
+
+ZARR_METADATA_KEYS = ('.zgroup', '.zattrs', '.zarray')
+
+
+class BlockCache:
+    """
+    Bytes stored as files in a directory, evicting the least recently used
+    once the total size exceeds max_size.
+
+    The directory is scanned once, after that sizes & LRU order are tracked
+    in memory, guarded by a lock as blocks are fetched from thread pools.
+    Access time is also recorded in the mtime, which orders the blocks the
+    next time the directory is scanned. In-flight *.tmp writes (possibly
+    from other processes) are not counted and never evicted.
+    """
+
+    def __init__(self, directory: str | Path | None = None,
+                 max_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = Path(directory or DEFAULT_CACHE_DIR)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Block file name -> size, least recently used first
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        stats = []
+        for f in self.blocks():
+            try:
+                stats.append((f.stat(), f.name))
+            except FileNotFoundError:
+                continue
+        for stat, name in sorted(stats, key=lambda entry: entry[0].st_mtime):
+            self.entries[name] = stat.st_size
+        self.size = sum(self.entries.values())
+
+    def blocks(self) -> Iterator[Path]:
+        return (f for f in self.directory.iterdir() if f.suffix != '.tmp')
+
+    def _path(self, key: str) -> Path:
+        return self.directory / hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            with self.lock:
+                # e.g. evicted by another process
+                self.size -= self.entries.pop(path.name, 0)
+            return None
+        with self.lock:
+            if path.name in self.entries:
+                self.entries.move_to_end(path.name)
+        os.utime(path)
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        # Write then rename, concurrent readers never see partial blocks
+        tmp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp.write_bytes(data)
+        with self.lock:
+            # Renamed under the lock, so an eviction can not unlink it unaccounted
+            tmp.replace(path)
+            self.size += len(data) - self.entries.pop(path.name, 0)
+            self.entries[path.name] = len(data)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            (self.directory / name).unlink(missing_ok=True)
+            self.size -= size
+
+
+_default_cache: BlockCache | None = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache() -> BlockCache:
+    """The BlockCache shared by every open_remote/open_anndata call"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = BlockCache()
+        return _default_cache
+
+
+def object_version(info: dict) -> str:
+    """Identifies an object's content, changes whenever the object does"""
+    return str(info.get('ETag') or info.get('etag')
+               or (info.get('size'), info.get('LastModified') or info.get('mtime')))
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Seekable, read-only file over a remote object
+    Reads are served from block-aligned range requests, via the BlockCache
+    """
+
+    def __init__(self, fs: fsspec.AbstractFileSystem, path: str, cache: BlockCache,
+                 block_size: int = DEFAULT_BLOCK_SIZE, workers: int = PREFETCH_WORKERS):
+        self.fs = fs
+        self.path = path
+        self.cache = cache
+        self.block_size = block_size
+        self.workers = workers
+        info = fs.info(path)
+        self.size = info['size']
+        self.version = object_version(info)
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.position
+
+    def _key(self, block: int) -> str:
+        return f"{self.fs.unstrip_protocol(self.path)}:{self.version}:{self.block_size}:{block}"
+
+    def _fetch(self, block: int) -> bytes:
+        start = block * self.block_size
+        end = min(start + self.block_size, self.size)
+        data = self.fs.cat_file(self.path, start=start, end=end)
+        self.cache.put(self._key(block), data)
+        return data
+
+    def blocks(self, first: int, last: int) -> dict[int, bytes]:
+        """Blocks first..last inclusive, missing blocks are fetched concurrently"""
+        found = {}
+        missing = []
+        for block in range(first, last + 1):
+            data = self.cache.get(self._key(block))
+            if data is None:
+                missing.append(block)
+            else:
+                found[block] = data
+        if len(missing) == 1:
+            found[missing[0]] = self._fetch(missing[0])
+        elif missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                found.update(zip(missing, executor.map(self._fetch, missing)))
+        return found
+
+    def prefetch(self, start: int = 0, length: int | None = None):
+        """Warm the cache for a byte range, by default the start of the file"""
+        length = PREFETCH_BLOCKS * self.block_size if length is None else length
+        end = min(start + length, self.size)
+        if end > start:
+            self.blocks(start // self.block_size, (end - 1) // self.block_size)
+
+    def readinto(self, buffer) -> int:
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        first = self.position // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = self.blocks(first, last)
+
+        view = memoryview(buffer)
+        written = 0
+        for block in range(first, last + 1):
+            offset = self.position + written - block * self.block_size
+            chunk = blocks[block][offset:offset + end - self.position - written]
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        self.position += written
+        return written
+
+
+class CachedStore(MutableMapping):
+    """Read-only zarr store over an fsspec mapper, caching keys in a BlockCache"""
+
+    def __init__(self, mapper: fsspec.FSMap, cache: BlockCache):
+        self.mapper = mapper
+        self.cache = cache
+        self.prefix = mapper.fs.unstrip_protocol(mapper.root)
+
+    def __getitem__(self, key: str) -> bytes:
+        cache_key = f"{self.prefix}/{key}"
+        data = self.cache.get(cache_key)
+        if data is None:
+            data = self.mapper[key]
+            self.cache.put(cache_key, data)
+        return data
+
+    def prefetch(self, keys):
+        """Fetch many keys concurrently, missing keys are skipped"""
+        missing = [k for k in keys if self.cache.get(f"{self.prefix}/{k}") is None]
+        if missing:
+            for key, data in self.mapper.getitems(missing, on_error='omit').items():
+                self.cache.put(f"{self.prefix}/{key}", data)
+
+    def __contains__(self, key) -> bool:
+        return self.cache.get(f"{self.prefix}/{key}") is not None or key in self.mapper
+
+    def __iter__(self):
+        return iter(self.mapper)
+
+    def __len__(self) -> int:
+        return len(self.mapper)
+
+    def __setitem__(self, key, value):
+        raise PermissionError("Remote datasets are read-only")
+
+    def __delitem__(self, key):
+        raise PermissionError("Remote datasets are read-only")
+
+
+def open_remote(uri: str, cache: BlockCache | None = None, **kwargs) -> RemoteFile:
+    fs, path = fsspec.core.url_to_fs(uri)
+    return RemoteFile(fs, path, cache or default_cache(), **kwargs)
+
+
+@contextmanager
+def open_anndata(uri: str, cache: BlockCache | None = None):
+    """
+    Open a remote h5ad/zarr AnnData store as an h5py.File/zarr.Group,
+    without downloading it. Metadata is prefetched concurrently.
+    """
+    cache = cache or default_cache()
+    if uri.rstrip('/').endswith('.zarr'):
+        fs, path = fsspec.core.url_to_fs(uri)
+        store = CachedStore(fs.get_mapper(path), cache)
+        if '.zmetadata' in store:
+            yield zarr.open_consolidated(store, mode='r')
+            return
+        keys = [
+            k for k in fs.find(path)
+            if k.rsplit('/', 1)[-1] in ZARR_METADATA_KEYS
+        ]
+        store.prefetch([k[len(path):].lstrip('/') for k in keys])
+        yield zarr.open_group(store, mode='r')
+    else:
+        with open_remote(uri, cache) as fh:
+            fh.prefetch()
+            with h5py.File(fh, 'r') as f:
+                yield f
+
+
+def read_obs_columns(group, columns: list[str]) -> pd.DataFrame:
+    """Read only the given obs columns of an h5py/zarr AnnData group"""
+    obs = group['obs']
+    return pd.DataFrame({column: read_elem(obs[column]) for column in columns})
+
+
+def obs_columns(group) -> list[str]:
+    return list(group['obs'].attrs.get('column-order', []))
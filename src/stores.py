@@ -0,0 +1,36 @@
+"""
+Opening AnnData stores, local or remote (e.g. s3://), as h5py/zarr groups.
+
+Kept free of heavy imports, h5py, zarr & remote.py are imported when a
+store is opened, so scripts can import is_remote for file discovery and
+still start quickly.
+"""
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+# e.g. s3://, gs://, but not file://
+PROTOCOL_PATTERN = re.compile(r'^(?P<protocol>[a-zA-Z][\w+.-]*)(::|://)')
+
+
+def is_remote(path) -> bool:
+    """True for fsspec URLs other than local files, e.g. s3://bucket/a.h5ad"""
+    match = PROTOCOL_PATTERN.match(str(path))
+    return match is not None and match['protocol'] not in ('file', 'local')
+
+
+@contextmanager
+def open_store(fpath: str | Path):
+    """h5py.File/zarr.Group for a local or remote h5ad/zarr AnnData store"""
+    import h5py
+    import zarr
+    from src.remote import open_anndata
+
+    if is_remote(fpath):
+        with open_anndata(str(fpath)) as group:
+            yield group
+    elif str(fpath).rstrip('/').endswith('.zarr'):
+        yield zarr.open_group(str(fpath), mode='r')
+    else:
+        with h5py.File(fpath, 'r') as f:
+            yield f
@@ -1,9 +1,16 @@
 import os
+import subprocess
+import sys
 from pathlib import Path
 
 import pytest
 
 import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import zarr
 from anndata.typing import ArrayDataStructureType
 
 from src.adata import adata, extract_layers
@@ -36,3 +43,82 @@ def test_extract_h5ad_layers():
     # assert a.__dict__.keys() == ['_layers']
     # metadata = extract_layers(ad)
 
+
+@pytest.fixture
+def layered_adata():
+    rng = np.random.default_rng(0)
+    X = sp.random(20, 10, density=0.2, format='csr', dtype=np.float32, random_state=rng)
+    a = ad.AnnData(
+        X,
+        obs=pd.DataFrame(index=[f"cell{i}" for i in range(20)]),
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(10)]),
+        layers={'counts': X.toarray().astype(np.int32)},
+        obsm={'X_umap': rng.random((20, 2)),
+              'meta': pd.DataFrame({'a': np.arange(20), 'b': np.ones(20)},
+                                   index=[f"cell{i}" for i in range(20)])},
+        obsp={'connectivities': sp.random(20, 20, density=0.1, format='csr', random_state=rng)},
+    )
+    a.raw = a
+    return a, X
+
+
+@pytest.mark.parametrize("suffix", [".h5ad", ".zarr"])
+def test_extract_layers(layered_adata, tmp_path, suffix):
+    a, X = layered_adata
+    fpath = tmp_path / f"layered{suffix}"
+    if suffix == ".h5ad":
+        a.write_h5ad(fpath, compression='gzip')
+    else:
+        a.write_zarr(fpath)
+
+    metadata = extract_layers(fpath)
+    assert isinstance(metadata, adata)
+    assert (metadata.n_obs, metadata.n_vars) == (20, 10)
+
+    assert metadata.X.encoding_type == 'csr_matrix'
+    assert metadata.X.format == 'csr'
+    assert metadata.X.shape == (20, 10)
+    assert metadata.X.dtype == 'float32'
+    assert metadata.X.nnz == X.nnz
+    assert metadata.X.nbytes == X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    if suffix == ".h5ad":
+        assert metadata.X.stored_bytes > 0
+    else:
+        assert metadata.X.stored_bytes is None
+    assert metadata.X.compression == ('gzip' if suffix == ".h5ad" else 'blosc:lz4')
+
+    counts = metadata.layers['counts']
+    assert (counts.format, counts.shape, counts.dtype) == ('dense', (20, 10), 'int32')
+    assert counts.nbytes == 20 * 10 * 4
+    assert counts.chunks is not None
+
+    assert metadata.obsm['X_umap'].shape == (20, 2)
+    assert metadata.obsm['meta'].encoding_type == 'dataframe'
+    assert metadata.obsm['meta'].shape == (20, 2)
+    assert metadata.obsp['connectivities'].format == 'csr'
+    assert metadata.varm == {} and metadata.varp == {}
+
+    assert metadata.raw.X.shape == (20, 10)
+    assert metadata.raw.n_vars == 10
+    assert metadata.nbytes >= metadata.X.nbytes + counts.nbytes + metadata.raw.X.nbytes
+
+
+def test_extract_layers_reads_no_values(layered_adata, tmp_path, monkeypatch):
+    a, _ = layered_adata
+    fpath = tmp_path / "layered.h5ad"
+    a.write_h5ad(fpath)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Dataset values were read")
+
+    monkeypatch.setattr(h5py.Dataset, "__getitem__", fail)
+    monkeypatch.setattr(h5py.Dataset, "read_direct", fail)
+    assert extract_layers(fpath).X.nnz == a.X.nnz
+
+
+def test_src_does_not_import_scripts():
+    code = ("import sys\nimport src.adata, src.remote\n"
+            "print(sorted(m for m in sys.modules if m.split('.')[0] == 'scripts'))\n")
+    result = subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent.parent,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
@@ -1,16 +1,34 @@
 import os
 import datetime
 import pathlib
+import signal
+import socket
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 
 import anndata as ad
+import fsspec
+import numpy as np
+import pandas as pd
 
 from scripts.extract_adata_metadata import (
     AnndataMetadata,
+    File,
+    SchemaValidation,
+    extract_files_metadata,
     extract_h5ad_metadata,
-    get_files
+    get_files,
+    load_validation_cache,
+    process_files,
+    run_schema_validation,
+    save_validation_cache,
+    schema_version,
+    validation_cache_key,
+    validate_files
 )
-from scripts.utils import size_convert, time_convert
+from scripts.celltype_proportions import count_cell_types
+from scripts.utils import fingerprint_file, size_convert, time_convert
 
 fixture_path = os.path.join(os.path.dirname(__file__), 'fixtures')
 
@@ -43,14 +61,72 @@ def test_get_files_with_symlinks():
     raise NotImplementedError
 
 
-@pytest.mark.skip(reason="NotImplemented Yet")
-def test_get_files_s3_interface():
-    raise NotImplementedError
+@pytest.fixture
+def s3_bucket(monkeypatch, tmp_path, small_h5ad):
+    """A local moto S3 server with a bucket containing two h5ad files"""
+    moto_server = pytest.importorskip("moto.server")
+    s3fs = pytest.importorskip("s3fs")
 
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setitem(fsspec.config.conf, "s3", {
+        "client_kwargs": {"endpoint_url": f"http://127.0.0.1:{port}"}})
+    monkeypatch.setattr("src.remote.DEFAULT_CACHE_DIR", tmp_path / "blocks")
+    # The shared cache is created on first use, with the patched directory
+    monkeypatch.setattr("src.remote._default_cache", None)
+    s3fs.S3FileSystem.clear_instance_cache()
+
+    fs = fsspec.filesystem("s3")
+    fs.mkdir("data")
+    fs.put_file(str(small_h5ad), "data/web/htan/small.h5ad")
+    fs.put_file(str(small_h5ad), "data/web/cellxgene/small_copy.h5ad")
+    fs.pipe_file("data/web/notes.txt", b"not a dataset")
+    yield fs
+    s3fs.S3FileSystem.clear_instance_cache()
+    # moto keeps its state in-process, reset it for the next test
+    urllib.request.urlopen(urllib.request.Request(
+        f"http://127.0.0.1:{port}/moto-api/reset", method="POST"))
+    server.stop()
+
+
+def test_get_files_s3_interface(s3_bucket):
+    assert get_files("s3://data", ('*.h5ad',)) == [
+        "s3://data/web/cellxgene/small_copy.h5ad",
+        "s3://data/web/htan/small.h5ad",
+    ]
 
-@pytest.mark.skip(reason="NotImplemented Yet")
-def test_get_files_s3_interface_with_prefix():
-    raise NotImplementedError
+
+def test_get_files_s3_interface_with_prefix(s3_bucket):
+    assert get_files("s3://data/web/htan", ('*.h5ad',)) == ["s3://data/web/htan/small.h5ad"]
+    assert get_files("s3://data/web/", ('*.txt',)) == ["s3://data/web/notes.txt"]
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_extract_s3_metadata(s3_bucket, small_h5ad):
+    files = extract_files_metadata(get_files("s3://data/web", ('*.h5ad',)))
+    assert [f.group for f in files] == ['cellxgene', 'htan']
+    assert files[0].fingerprint == files[1].fingerprint == fingerprint_file(small_h5ad)
+    assert files[1].duplicate_of == "s3://data/web/cellxgene/small_copy.h5ad"
+    # Remote URIs survive a JSON round trip, Path would collapse s3:// to s3:/
+    assert File.model_validate_json(files[1].model_dump_json()) == files[1]
+
+    metadata = extract_h5ad_metadata("s3://data/web/htan/small.h5ad")
+    assert metadata.shape == (5, 3)
+    assert metadata.obs == ['cell_type']
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_count_s3_cell_types(s3_bucket):
+    c = count_cell_types("s3://data/web/htan/small.h5ad")
+    assert c.file == "s3://data/web/htan/small.h5ad"
+    assert c.cell_types == {'T cell': 2, 'B cell': 2, 'monocyte': 1}
 
 
 @pytest.mark.filterwarnings("ignore")  # Ignore anndata OldFormatWarning
@@ -64,6 +140,125 @@ def test_extract_h5ad_metadata():
     assert metadata.obsm == ['X_pca', 'X_tsne', 'X_umap', 'X_draw_graph_fr']
 
 
+@pytest.fixture
+def small_h5ad(tmp_path):
+    obs = pd.DataFrame(
+        {'cell_type': pd.Categorical(['T cell', 'T cell', 'B cell', 'B cell', 'monocyte'])},
+        index=[f"cell{i}" for i in range(5)])
+    var = pd.DataFrame(index=['ENSG00000141510', 'ENSG00000012048', 'ENSG00000139618'])
+    adata = ad.AnnData(np.arange(15, dtype='float32').reshape(5, 3), obs=obs, var=var)
+    fpath = tmp_path / "small.h5ad"
+    adata.write_h5ad(fpath)
+    return fpath
+
+
+def test_fingerprint_file(tmp_path):
+    a = tmp_path / "a.bin"
+    b = tmp_path / "b.bin"
+    a.write_bytes(b"x" * 5_000_000)
+    b.write_bytes(b"x" * 5_000_000)
+    assert fingerprint_file(a) == fingerprint_file(b)
+    b.write_bytes(b"x" * 4_999_999 + b"y")
+    assert fingerprint_file(a) != fingerprint_file(b)
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_validate_files_cached(small_h5ad, tmp_path, monkeypatch):
+    import cellxgene_schema.validate
+    import scripts.extract_adata_metadata as extract
+
+    # small_h5ad makes validate() raise, which is not cached
+    monkeypatch.setattr(cellxgene_schema.validate, "validate",
+                        lambda f: (False, ["ERROR: missing obs column"], None))
+    # SIGALRM timeouts only work in the main thread
+    monkeypatch.setattr(extract, "ProcessPoolExecutor", ThreadPoolExecutor)
+    cache_path = tmp_path / "cache.json"
+    files = extract_files_metadata([small_h5ad])
+    results = validate_files(files, cache_path=cache_path, workers=1, timeout=0)
+    result = results[small_h5ad]
+    assert isinstance(result, SchemaValidation)
+    assert not result.is_valid
+    assert result.errors == ["ERROR: missing obs column"]
+    assert result.completed
+
+    cache = load_validation_cache(cache_path)
+    key = validation_cache_key(result.fingerprint)
+    assert cache == {key: result}
+    assert key.startswith(schema_version())
+
+    # Unchanged files are served from the cache
+    cache[key].errors = ["cached"]
+    save_validation_cache(cache_path, cache)
+    assert validate_files(files, cache_path=cache_path)[small_h5ad].errors == ["cached"]
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_validate_files_skips_caching_failures(small_h5ad, tmp_path, monkeypatch):
+    def dead_worker(f, fingerprint, timeout):
+        raise RuntimeError("worker died")
+
+    import scripts.extract_adata_metadata as extract
+
+    monkeypatch.setattr(extract, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(extract, "run_schema_validation", dead_worker)
+    cache_path = tmp_path / "cache.json"
+    results = validate_files(extract_files_metadata([small_h5ad]), cache_path=cache_path)
+    assert results[small_h5ad].errors == ["Validation failed: RuntimeError('worker died')"]
+    assert load_validation_cache(cache_path) == {}
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGALRM'), reason="SIGALRM is Unix only")
+@pytest.mark.parametrize("swallowed", [Exception, BaseException])
+def test_run_schema_validation_timeout(small_h5ad, monkeypatch, swallowed):
+    import time
+    import cellxgene_schema.validate
+
+    def validate(f):
+        # cellxgene-schema records exceptions raised by its checks as errors
+        errors = []
+        try:
+            time.sleep(5)
+        except swallowed as exc:
+            errors.append(repr(exc))
+        return False, errors, None
+
+    monkeypatch.setattr(cellxgene_schema.validate, "validate", validate)
+    result = run_schema_validation(small_h5ad, "abc", timeout=1)
+    assert result.timed_out
+    assert not result.completed
+    assert result.errors == ["Validation timed out after 1s"]
+    assert result.elapsed < 5
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_process_files_schema_errors(small_h5ad):
+    validation = SchemaValidation(fingerprint="abc", errors=["ERROR: missing obs column"])
+    [combined] = process_files(extract_files_metadata([small_h5ad]), {small_h5ad: validation})
+    assert combined.metadata.shape == (5, 3)
+    assert combined.errors == [{
+        'type': 'cellxgene_schema',
+        'loc': ('cellxgene_schema',),
+        'msg': "ERROR: missing obs column",
+        'input': str(small_h5ad),
+    }]
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_duplicate_datasets(small_h5ad, tmp_path):
+    copy = tmp_path / "cellxgene" / small_h5ad.name
+    copy.parent.mkdir()
+    copy.write_bytes(small_h5ad.read_bytes())
+
+    original, duplicate = extract_files_metadata([small_h5ad, copy])
+    assert original.fingerprint == duplicate.fingerprint
+    assert original.duplicate_of is None
+    assert duplicate.duplicate_of == small_h5ad
+    assert File.model_validate_json(duplicate.model_dump_json()).duplicate_of == small_h5ad
+
+    combined = process_files([original, duplicate])
+    assert combined[0].metadata == combined[1].metadata
+
+
 @pytest.mark.skip(reason="WIP")
 @pytest.mark.filterwarnings("ignore")  # Ignore anndata OldFormatWarning
 @pytest.mark.usefixtures("fake_filesystem")
@@ -0,0 +1,107 @@
+import pytest
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+
+from scripts.cell_ontology import (
+    CellOntologyIndex,
+    cell_type_columns,
+    harmonize_obs,
+    normalize
+)
+from scripts.celltype_proportions import CellProportionListModel, count_cell_types, process_files
+
+ONTOLOGY = {
+    'CL:0000000': {'label': 'cell', 'ancestors': {}, 'deprecated': False},
+    'CL:0000542': {'label': 'lymphocyte', 'ancestors': {'CL:0000000': 1},
+                   'deprecated': False},
+    'CL:0000084': {'label': 'T cell', 'ancestors': {'CL:0000542': 1, 'CL:0000000': 2},
+                   'synonyms': ['T lymphocyte', 'T-cell'], 'deprecated': False},
+    'CL:0000236': {'label': 'B cell', 'ancestors': {'CL:0000542': 1, 'CL:0000000': 2},
+                   'deprecated': False},
+    'CL:0000066': {'label': 'epithelial cell', 'ancestors': {'CL:0000000': 1},
+                   'deprecated': False},
+    'CL:0000003': {'label': 'obsolete native cell', 'ancestors': {}, 'deprecated': True},
+}
+
+
+@pytest.fixture
+def index():
+    return CellOntologyIndex(ONTOLOGY)
+
+
+def test_normalize():
+    assert normalize("CD8+ T-cells") == ('cd8', 'cell', 'positive', 't')
+    assert normalize("T cell") == normalize("cells, T")
+
+
+@pytest.mark.parametrize("label,expected", [
+    ("CL:0000084", 'CL:0000084'),
+    ("CL:0000003", None),
+    ("T cell", 'CL:0000084'),
+    ("t lymphocyte", 'CL:0000084'),
+    ("T-Cells", 'CL:0000084'),
+    ("B cells", 'CL:0000236'),
+    ("Epithelial", 'CL:0000066'),
+    ("Tumor", None),
+])
+def test_resolve(index, label, expected):
+    assert index.resolve(label) == expected
+
+
+def test_rollup(index):
+    assert index.rollup({'CL:0000084': 3, 'CL:0000236': 2}) == {
+        'CL:0000084': 3,
+        'CL:0000236': 2,
+        'CL:0000542': 5,
+        'CL:0000000': 5,
+    }
+
+
+def test_cell_type_columns():
+    columns = ['donor_id', 'celltype_L1', 'celltype_L3', 'celltype_L2', 'cell_type_ontology_term_id']
+    assert cell_type_columns(columns) == ['celltype_L3', 'celltype_L2', 'celltype_L1']
+
+
+def test_harmonize_obs(index):
+    obs = pd.DataFrame({
+        'celltype_L1': pd.Categorical(['Immune', 'Immune', 'Immune', 'Epithelial', 'Other']),
+        'celltype_L2': pd.Categorical(['T cells', 'T cells', 'B cells', 'Tumor', None]),
+    })
+    labels, terms = harmonize_obs(obs, ['celltype_L2', 'celltype_L1'], index)
+    assert labels == {'T cell': 2, 'B cell': 1, 'epithelial cell': 1, 'unknown': 1}
+    assert terms == {'CL:0000084': 2, 'CL:0000236': 1, 'CL:0000066': 1}
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_count_cell_types_harmonized(tmp_path):
+    obs = pd.DataFrame(
+        {'celltype_L1': pd.Categorical(['T cells', 'T cells', 'Fibroblasts', 'Unassigned'])},
+        index=[f"cell{i}" for i in range(4)])
+    fpath = tmp_path / "unannotated.h5ad"
+    ad.AnnData(np.ones((4, 2), dtype='float32'), obs=obs).write_h5ad(fpath)
+
+    c = count_cell_types(fpath)
+    assert c.harmonized_from == ['celltype_L1']
+    assert c.cell_types == {'T cell': 2, 'fibroblast': 1, 'unknown': 1}
+    assert c.ontology_counts['CL:0000084'] == 2
+    assert c.ontology_counts['CL:0000000'] == 3
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_process_files_duplicate_keeps_harmonized_counts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    obs = pd.DataFrame({'celltype_L1': pd.Categorical(['T cells', 'T cells'])},
+                       index=['cell0', 'cell1'])
+    original = tmp_path / "web" / "a.h5ad"
+    copy = tmp_path / "cellxgene" / "a.h5ad"
+    for fpath in (original, copy):
+        fpath.parent.mkdir()
+        ad.AnnData(np.ones((2, 2), dtype='float32'), obs=obs).write_h5ad(fpath)
+
+    process_files([original, copy], groups=['cellxgene'])
+    [_, group] = CellProportionListModel.validate_json(
+        (tmp_path / "cell_proportions.json").read_bytes())
+    assert group.cell_types == {'T cell': 2}
+    assert group.ontology_counts['CL:0000084'] == 2
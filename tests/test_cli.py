@@ -0,0 +1,82 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from scripts.cli import build_parser, main
+
+ROOT = Path(__file__).parent.parent
+HEAVY_MODULES = ('anndata', 'pandas', 'sqlalchemy', 'supabase', 'h5py', 'zarr')
+
+
+@pytest.mark.parametrize("argv,command", [
+    (["extract", "-i", "data"], "extract"),
+    (["proportions", "-i", "data", "-g", "groups.txt"], "proportions"),
+    (["transform", "--dry-run"], "transform"),
+    (["upload", "-i", "output.json", "--dry-run"], "upload"),
+    (["index", "-i", "data", "-q", "ENSG00000141510"], "index"),
+    (["rechunk", "-i", "a.h5ad", "--memory-limit", "4096"], "rechunk"),
+    (["convert", "-i", "a.h5ad", "-o", "a.zarr"], "convert"),
+])
+def test_parse_subcommands(argv, command):
+    args = build_parser().parse_args(argv)
+    assert args.command == command
+    assert callable(args.run)
+
+
+@pytest.mark.parametrize("code", [
+    "from scripts.cli import main\ntry:\n    main(['--help'])\nexcept SystemExit:\n    pass\n",
+    # Imported by the watch & proportions commands before any file is read
+    "import scripts.celltype_proportions\n",
+])
+def test_skips_heavy_imports(code):
+    """--help only needs the standard library, heavy modules load on use"""
+    code = f"import sys\n{code}print([m for m in {HEAVY_MODULES!r} if m in sys.modules])\n"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_list_files_skips_pydantic(tmp_path):
+    """extract/proportions/subsample --dry-run only list files"""
+    code = ("import sys\nfrom scripts.cli import main\n"
+            f"main(['extract', '-i', {str(tmp_path)!r}, '--dry-run'])\n"
+            "print('pydantic' in sys.modules)\n")
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-1] == "False"
+
+
+def test_upload_dry_run(tmp_path, monkeypatch, capsys):
+    monkeypatch.delenv("SUPABASE_URL", raising=False)
+    monkeypatch.delenv("SUPABASE_KEY", raising=False)
+    records = tmp_path / "output.json"
+    records.write_text(json.dumps([{"dataset": "a"}, {"dataset": "b"}]))
+
+    main(["upload", "-i", str(records), "--dry-run"])
+    assert "2 Records to insert" in capsys.readouterr().out
+
+
+def test_transform_dry_run(tmp_path, capsys):
+    cell_types = tmp_path / "cell_types.json"
+    cell_types.write_text(json.dumps({"T cell": 3, "B cell": 1}))
+    cell_proportions = tmp_path / "cell_proportions.json"
+    cell_proportions.write_text(json.dumps([
+        {"file": "web/a.h5ad", "cell_types": {"T cell": 3}},
+        {"file": "htan", "cell_types": {"B cell": 1}},
+    ]))
+
+    main(["transform", "--dry-run", "--cell-types", str(cell_types),
+          "--cell-proportions", str(cell_proportions)])
+    assert capsys.readouterr().out.splitlines() == ["\ta\thtan", "T cell\t3\t0", "B cell\t0\t1"]
+
+
+def test_extract_dry_run_lists_files(tmp_path, capsys):
+    (tmp_path / "a.h5ad").touch()
+    (tmp_path / "notes.txt").touch()
+    main(["extract", "-i", str(tmp_path), "--dry-run"])
+    out = capsys.readouterr().out
+    assert str(tmp_path / "a.h5ad") in out
+    assert "1 files" in out
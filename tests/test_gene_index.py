@@ -0,0 +1,77 @@
+import pytest
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+
+from scripts.extract_adata_metadata import extract_files_metadata
+from scripts import gene_index
+from scripts.cli import main
+from scripts.gene_index import GeneIndex, iter_var_names, read_var_names
+
+
+def write_h5ad(fpath, genes):
+    var = pd.DataFrame(index=genes)
+    ad.AnnData(np.ones((3, len(genes)), dtype='float32'), var=var).write_h5ad(fpath)
+    return fpath
+
+
+@pytest.fixture
+def datasets(tmp_path):
+    return [
+        write_h5ad(tmp_path / "a.h5ad", ['ENSG00000141510', 'ENSG00000012048']),
+        write_h5ad(tmp_path / "b.h5ad", ['ENSG00000139618', 'ENSG00000141510']),
+    ]
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_read_var_names(datasets):
+    assert read_var_names(datasets[0]).tolist() == ['ENSG00000141510', 'ENSG00000012048']
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_gene_index(datasets, tmp_path):
+    a, b = datasets
+    with GeneIndex(tmp_path / "genes.sqlite") as index:
+        assert index.update(extract_files_metadata(datasets)) == [a, b]
+        assert index.lookup('ENSG00000141510') == [(str(a), 0), (str(b), 1)]
+        assert index.datasets_with_gene('ENSG00000139618') == [str(b)]
+        assert index.lookup('ENSG00000000000') == []
+
+        # Unchanged datasets are not re-read
+        assert index.update(extract_files_metadata(datasets)) == []
+
+        write_h5ad(b, ['ENSG00000012048'])
+        assert index.update(extract_files_metadata(datasets)) == [b]
+        assert index.datasets_with_gene('ENSG00000012048') == [str(a), str(b)]
+        assert index.datasets_with_gene('ENSG00000139618') == []
+
+        b.unlink()
+        assert index.prune(extract_files_metadata([a])) == [str(b)]
+        assert index.lookup('ENSG00000012048') == [(str(a), 1)]
+
+
+def test_remove_uses_dataset_index(tmp_path):
+    with GeneIndex(tmp_path / "genes.sqlite") as index:
+        plan = index.db.execute(
+            'EXPLAIN QUERY PLAN DELETE FROM gene_positions WHERE dataset_id = ?', (1,)).fetchall()
+    assert any('gene_positions_dataset' in row[-1] for row in plan)
+
+
+def test_iter_var_names_bounded(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(gene_index, "read_var_names", lambda f: submitted.append(f) or f)
+    names = iter_var_names(list(range(10)), workers=1)
+    assert next(names) == 0
+    # Reads are submitted as results are consumed, not all up front
+    assert len(submitted) <= 2
+    assert list(names) == list(range(1, 10))
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_index_command(datasets, tmp_path, capsys):
+    a, b = datasets
+    database = tmp_path / "genes.sqlite"
+    main(["index", "-i", str(tmp_path), "-d", str(database), "-q", "ENSG00000139618"])
+    assert capsys.readouterr().out.splitlines() == [
+        "Removed 0 datasets", "Indexed 2 datasets", f"ENSG00000139618\t{b}\t0"]
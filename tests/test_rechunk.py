@@ -0,0 +1,46 @@
+import pytest
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from anndata.io import read_elem
+import zarr
+
+from scripts.rechunk import GeneMajorStore, assign_stripes, rechunk_gene_major
+
+
+@pytest.fixture(params=['csr', 'csc', 'dense'])
+def expression_h5ad(request, tmp_path):
+    rng = np.random.default_rng(0)
+    X = sp.random(500, 40, density=0.1, format='csr', dtype=np.float32, random_state=rng)
+    var = pd.DataFrame(index=[f"ENSG{i:011d}" for i in range(40)])
+    obs = pd.DataFrame(index=[f"cell{i}" for i in range(500)])
+    matrices = {'csr': X, 'csc': X.tocsc(), 'dense': X.toarray()}
+    adata = ad.AnnData(matrices[request.param], obs=obs, var=var)
+    fpath = tmp_path / f"{request.param}.h5ad"
+    adata.write_h5ad(fpath)
+    return fpath, X.toarray()
+
+
+def test_assign_stripes():
+    assert assign_stripes(np.array([3, 3, 3, 10, 1]), 6).tolist() == [0, 0, 1, 2, 3]
+
+
+@pytest.mark.parametrize("memory_limit", [1024 ** 3, 4096])
+def test_rechunk_gene_major(expression_h5ad, tmp_path, memory_limit):
+    fpath, dense = expression_h5ad
+    output = rechunk_gene_major(fpath, tmp_path / "out.genes.zarr",
+                                chunk_size=64, memory_limit=memory_limit,
+                                spill_dir=tmp_path)
+    X = read_elem(zarr.open_group(str(output), mode='r')['X'])
+    assert isinstance(X, sp.csc_matrix)
+    assert X.has_sorted_indices
+    np.testing.assert_array_equal(X.toarray(), dense)
+
+    store = GeneMajorStore(output)
+    np.testing.assert_array_equal(store.read_gene(7), dense[:, 7])
+    np.testing.assert_array_equal(store.read_gene("ENSG00000000012"), dense[:, 12])
+    cells, values = store.read_gene_sparse(3)
+    np.testing.assert_array_equal(cells, np.flatnonzero(dense[:, 3]))
+    np.testing.assert_array_equal(values, dense[cells, 3])
@@ -0,0 +1,111 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import fsspec
+
+from src import remote
+from src.remote import BlockCache, RemoteFile, is_remote, open_remote
+
+
+@pytest.fixture
+def memory_fs():
+    fs = fsspec.filesystem("memory")
+    fs.pipe_file("/bucket/data.bin", bytes(range(256)) * 1024)
+    yield fs
+    fs.rm("/bucket", recursive=True)
+
+
+@pytest.fixture
+def fetches(memory_fs, monkeypatch):
+    """Byte ranges requested from the remote filesystem"""
+    requested = []
+    cat_file = memory_fs.cat_file
+
+    def record(path, start=None, end=None, **kwargs):
+        requested.append((start, end))
+        return cat_file(path, start=start, end=end, **kwargs)
+
+    monkeypatch.setattr(memory_fs, "cat_file", record)
+    return requested
+
+
+@pytest.mark.parametrize("path,expected", [
+    ("s3://bucket/a.h5ad", True),
+    ("memory://bucket/a.h5ad", True),
+    ("file:///data/a.h5ad", False),
+    ("data/web/a.h5ad", False),
+])
+def test_is_remote(path, expected):
+    assert is_remote(path) == expected
+
+
+def test_remote_file_reads_ranges(memory_fs, fetches, tmp_path):
+    expected = memory_fs.cat_file("/bucket/data.bin")
+    fetches.clear()
+    cache = BlockCache(tmp_path)
+    with RemoteFile(memory_fs, "/bucket/data.bin", cache, block_size=4096) as fh:
+        fh.seek(5000)
+        assert fh.read(10_000) == expected[5000:15_000]
+        # Only the blocks covering the read are fetched, concurrently
+        assert sorted(fetches) == [(4096, 8192), (8192, 12288), (12288, 16384)]
+
+        # Cached blocks are not fetched again
+        fetches.clear()
+        fh.seek(6000)
+        assert fh.read(100) == expected[6000:6100]
+        assert fetches == []
+
+        fh.seek(-10, os.SEEK_END)
+        assert fh.read() == expected[-10:]
+        assert fh.read() == b""
+
+
+def test_block_cache_evicts_least_recently_used(tmp_path):
+    cache = BlockCache(tmp_path, max_size=250)
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    assert cache.get("a") == b"a" * 100  # Touches a, b is now the oldest
+    cache.put("c", b"c" * 100)
+    assert cache.get("b") is None
+    assert cache.get("a") == b"a" * 100
+    assert cache.get("c") == b"c" * 100
+    assert cache.size == 200
+
+    # After a restart, blocks are ordered by the access time in their mtime
+    os.utime(cache._path("c"), (1, 1))
+    restarted = BlockCache(tmp_path, max_size=250)
+    assert list(restarted.entries) == [cache._path("c").name, cache._path("a").name]
+    restarted.put("d", b"d" * 100)
+    assert restarted.get("c") is None
+    assert restarted.get("a") == b"a" * 100
+
+
+def test_block_cache_concurrent_puts(tmp_path):
+    cache = BlockCache(tmp_path, max_size=50 * 100)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.put(str(i % 80), b"x" * 100), range(400)))
+    assert cache.size == sum(f.stat().st_size for f in tmp_path.iterdir()) <= 50 * 100
+
+
+def test_default_cache_is_shared(memory_fs, tmp_path, monkeypatch):
+    monkeypatch.setattr(remote, "DEFAULT_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(remote, "_default_cache", None)
+    with open_remote("memory://bucket/data.bin") as a, open_remote("memory://bucket/data.bin") as b:
+        assert a.cache is b.cache is remote.default_cache()
+        assert a.cache.directory == tmp_path
+
+
+def test_block_cache_overwrite_and_tmp_files(tmp_path):
+    cache = BlockCache(tmp_path, max_size=250)
+    cache.put("a", b"a" * 100)
+    cache.put("a", b"a" * 100)
+    assert cache.size == 100
+
+    # Another process' in-flight write is neither counted nor evicted
+    in_flight = tmp_path / "block.1234.tmp"
+    in_flight.write_bytes(b"x" * 1000)
+    assert BlockCache(tmp_path, max_size=250).size == 100
+    cache.put("b", b"b" * 200)
+    assert in_flight.exists()
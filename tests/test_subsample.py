@@ -0,0 +1,134 @@
+import anndata as ad
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+from scripts.subsample import (allocate, iter_spans, preview_paths, read_rows, stratified_rows,
+                               subsample_dataset, subsample_datasets)
+from scripts.utils import open_store
+
+
+@pytest.fixture
+def typed_adata():
+    rng = np.random.default_rng(0)
+    n_obs, n_vars = 1000, 30
+    cell_types = np.repeat(['T cell', 'B cell', 'monocyte', 'rare'], [700, 200, 95, 5])
+    obs = pd.DataFrame({'cell_type': pd.Categorical(cell_types)},
+                       index=[f"cell{i}" for i in range(n_obs)])
+    X = sp.random(n_obs, n_vars, density=0.1, format='csr', dtype=np.float32, random_state=rng)
+    return ad.AnnData(
+        X, obs=obs,
+        var=pd.DataFrame(index=[f"gene{i}" for i in range(n_vars)]),
+        layers={'counts': X.toarray()},
+        obsm={'X_umap': rng.random((n_obs, 2))},
+    )
+
+
+def test_allocate():
+    counts = np.array([700, 200, 95, 5])
+    allocation = allocate(counts, 100, min_per_type=10)
+    assert allocation.sum() == 100
+    assert allocation[3] == 5  # All of the rare type
+    assert (allocation <= counts).all()
+    assert allocation[0] > allocation[1] > allocation[2]
+    # Everything fits
+    assert (allocate(counts, 5000) == counts).all()
+    # Minimums exceed n, proportional only
+    assert allocate(np.full(20, 10), 10, min_per_type=5).sum() == 10
+
+
+def test_stratified_rows():
+    codes = np.repeat([0, 1, 2], [700, 200, 100])
+    rows = stratified_rows(codes, 100, min_per_type=0, seed=1)
+    assert (np.diff(rows) > 0).all()
+    assert np.bincount(codes[rows]).tolist() == [70, 20, 10]
+    assert (stratified_rows(codes, 100, seed=1) == stratified_rows(codes, 100, seed=1)).all()
+
+
+def test_iter_spans():
+    starts = np.array([0, 10, 100, 105])
+    stops = np.array([5, 20, 102, 110])
+    assert list(iter_spans(starts, stops, gap=10, max_span=1000)) == [
+        (0, 20, slice(0, 2)), (100, 110, slice(2, 4))]
+    assert list(iter_spans(starts, stops, gap=10, max_span=15)) == [
+        (0, 5, slice(0, 1)), (10, 20, slice(1, 2)), (100, 110, slice(2, 4))]
+
+
+@pytest.mark.parametrize("suffix", [".h5ad", ".zarr"])
+def test_read_rows(typed_adata, tmp_path, suffix):
+    fpath = tmp_path / f"typed{suffix}"
+    typed_adata.obsm['X_csc'] = typed_adata.X.tocsc()
+    if suffix == ".h5ad":
+        typed_adata.write_h5ad(fpath)
+    else:
+        typed_adata.write_zarr(fpath, chunks=(64, 30))
+    rows = np.array([0, 3, 4, 63, 64, 500, 999])
+    with open_store(fpath) as f:
+        assert (read_rows(f['X'], rows).toarray() == typed_adata.X[rows].toarray()).all()
+        assert (read_rows(f['layers']['counts'], rows) == typed_adata.layers['counts'][rows]).all()
+        assert (read_rows(f['obsm']['X_umap'], rows) == typed_adata.obsm['X_umap'][rows]).all()
+        assert (read_rows(f['obsm']['X_csc'], rows).toarray() == typed_adata.X[rows].toarray()).all()
+
+
+@pytest.mark.parametrize("suffix", [".zarr", ".h5ad"])
+def test_subsample_dataset(typed_adata, tmp_path, suffix):
+    fpath = tmp_path / "typed.h5ad"
+    typed_adata.write_h5ad(fpath)
+    output = tmp_path / f"typed.preview{suffix}"
+
+    preview = subsample_dataset(fpath, output, n_cells=100, min_per_type=10)
+    assert (preview.n_obs, preview.n_sampled) == (1000, 100)
+    assert preview.cell_types['rare'] == 5
+
+    subset = ad.read_zarr(output) if suffix == ".zarr" else ad.read_h5ad(output)
+    assert subset.shape == (100, 30)
+    expected = typed_adata[subset.obs_names]
+    assert (subset.X.toarray() == expected.X.toarray()).all()
+    assert (subset.layers['counts'] == expected.layers['counts']).all()
+    assert (subset.obsm['X_umap'] == expected.obsm['X_umap']).all()
+    assert subset.obs['cell_type'].value_counts().to_dict() == preview.cell_types
+    assert subset.uns['preview']['n_obs'] == 1000
+
+
+def test_subsample_datasets(typed_adata, tmp_path):
+    files = []
+    for name, adata in (("a", typed_adata), ("b", typed_adata[:900].copy())):
+        files.append(tmp_path / f"{name}.h5ad")
+        adata.write_h5ad(files[-1])
+    files.append(tmp_path / "broken.h5ad")
+    files[-1].write_bytes(b"not hdf5")
+
+    previews = subsample_datasets(files, tmp_path / "previews", workers=2, n_cells=50)
+    assert [p.n_sampled for p in previews[:2]] == [50, 50]
+    assert (tmp_path / "previews" / "a.preview.zarr").exists()
+    assert previews[2].error is not None
+
+
+def test_preview_paths():
+    files = ["data/web/htan/a.h5ad", "data/web/cellxgene/a.h5ad"]
+    assert [str(p) for p in preview_paths(files)] == ["htan/a.preview.zarr", "cellxgene/a.preview.zarr"]
+    assert [str(p) for p in preview_paths(files, '.h5ad', root="data")] \
+        == ["web/htan/a.preview.h5ad", "web/cellxgene/a.preview.h5ad"]
+    assert [str(p) for p in preview_paths(["s3://bucket/web/htan/a.h5ad"], root="s3://bucket/web")] \
+        == ["htan/a.preview.zarr"]
+
+
+def test_subsample_datasets_groups(typed_adata, tmp_path):
+    # Same name in two groups, and an exact copy of one of them
+    files = [tmp_path / "web" / group / "a.h5ad" for group in ("htan", "cellxgene", "copies")]
+    for f, adata in zip(files, (typed_adata, typed_adata[:900].copy(), typed_adata)):
+        f.parent.mkdir(parents=True)
+        adata.write_h5ad(f)
+
+    previews = subsample_datasets(files, tmp_path / "previews", workers=2,
+                                  root=tmp_path / "web", n_cells=50)
+    assert [p.output for p in previews] == [
+        str(tmp_path / "previews" / "htan" / "a.preview.zarr"),
+        str(tmp_path / "previews" / "cellxgene" / "a.preview.zarr"),
+        None,
+    ]
+    assert previews[2].duplicate_of == str(files[0])
+    assert not (tmp_path / "previews" / "copies").exists()
+    with open_store(tmp_path / "previews" / "cellxgene" / "a.preview.zarr") as f:
+        assert f['uns']['preview']['source'][()] == str(files[1])
@@ -0,0 +1,249 @@
+import itertools
+import json
+import os
+import sys
+
+import pytest
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+
+from scripts import watch
+from scripts.watch import (
+    EVENT_HEADER,
+    IN_Q_OVERFLOW,
+    DatasetIndex,
+    EventsLost,
+    InotifyWatcher,
+    PollingWatcher
+)
+
+
+def write_h5ad(fpath, cell_types):
+    obs = pd.DataFrame(
+        {'cell_type': pd.Categorical(cell_types)},
+        index=[f"cell{i}" for i in range(len(cell_types))])
+    adata = ad.AnnData(np.ones((len(cell_types), 2), dtype='float32'), obs=obs)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    adata.write_h5ad(fpath)
+    return fpath
+
+
+def test_polling_watcher(tmp_path):
+    watcher = PollingWatcher(tmp_path, ('*.h5ad',), interval=0)
+    assert watcher.read_events() == set()
+    f = write_h5ad(tmp_path / "group" / "a.h5ad", ['T cell'])
+    assert watcher.read_events() == {f}
+    f.unlink()
+    assert watcher.read_events() == {f}
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is Linux only")
+def test_inotify_watcher(tmp_path):
+    (tmp_path / "existing").mkdir()
+    watcher = InotifyWatcher(tmp_path)
+    try:
+        a = write_h5ad(tmp_path / "existing" / "a.h5ad", ['T cell'])
+        assert a in watcher.read_events(timeout=1)
+        # Directories created after startup are watched too
+        (tmp_path / "new").mkdir()
+        watcher.read_events(timeout=1)
+        b = write_h5ad(tmp_path / "new" / "b.h5ad", ['B cell'])
+        assert b in watcher.read_events(timeout=1)
+    finally:
+        watcher.close()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason="inotify is Linux only")
+def test_inotify_watcher_overflow(tmp_path, monkeypatch):
+    watcher = InotifyWatcher(tmp_path)
+    try:
+        # The kernel reports a full queue with wd -1 & IN_Q_OVERFLOW,
+        # the directory created meanwhile was never reported
+        (tmp_path / "missed").mkdir()
+        monkeypatch.setattr(watch.os, "read",
+                            lambda fd, n: EVENT_HEADER.pack(-1, IN_Q_OVERFLOW, 0, 0))
+        with pytest.raises(EventsLost):
+            watcher.read_events(timeout=1)
+        assert tmp_path / "missed" in watcher.directories.values()
+    finally:
+        watcher.close()
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_dataset_index_update(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = write_h5ad(tmp_path / "web" / "a.h5ad", ['T cell', 'T cell', 'B cell'])
+    b = write_h5ad(tmp_path / "web" / "b.h5ad", ['B cell'])
+
+    index = DatasetIndex(output=tmp_path / "output.json")
+    assert index.update([a, b]) == [a, b]
+    assert json.loads((tmp_path / "cell_types.json").read_text()) == {'T cell': 2, 'B cell': 2}
+    assert [d['dataset'] for d in json.loads((tmp_path / "output.json").read_text())] \
+        == ['a.h5ad', 'b.h5ad']
+
+    # Unchanged files are not re-extracted
+    assert index.update([a, b]) == []
+
+    write_h5ad(b, ['monocyte'])
+    a.unlink()
+    assert index.update([a, b]) == [b]
+    assert json.loads((tmp_path / "cell_types.json").read_text()) == {'monocyte': 1}
+    assert [d['dataset'] for d in json.loads((tmp_path / "output.json").read_text())] \
+        == ['b.h5ad']
+
+    # Previous results are reused after a restart
+    restarted = DatasetIndex(output=tmp_path / "output.json")
+    restarted.seed()
+    assert restarted.update([b]) == []
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_dataset_index_seed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = write_h5ad(tmp_path / "web" / "htan" / "a.h5ad", ['T cell'])
+    b = write_h5ad(tmp_path / "web" / "other" / "b.h5ad", ['B cell'])
+    DatasetIndex(output=tmp_path / "output.json", groups=['htan']).update([a, b])
+
+    # Grouped datasets are reused, a dataset removed while not watching
+    # does not invalidate the others
+    b.unlink()
+    restarted = DatasetIndex(output=tmp_path / "output.json", groups=['htan'])
+    restarted.seed()
+    assert restarted.stale == {b}
+    assert restarted.update([a, *restarted.stale]) == []
+    assert [d['dataset'] for d in json.loads((tmp_path / "output.json").read_text())] \
+        == ['a.h5ad']
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_dataset_index_skips_unreadable_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = write_h5ad(tmp_path / "web" / "a.h5ad", ['T cell'])
+    truncated = tmp_path / "web" / "b.h5ad"
+    truncated.write_bytes(b"not an hdf5 file")
+
+    index = DatasetIndex(output=tmp_path / "output.json")
+    assert index.update([a, truncated]) == [a]
+    assert truncated in index.errors
+    assert [d['dataset'] for d in json.loads((tmp_path / "output.json").read_text())] \
+        == ['a.h5ad']
+
+    # Retried once the file changes again
+    write_h5ad(truncated, ['B cell'])
+    assert index.update([truncated]) == [truncated]
+    assert index.errors == {}
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_dataset_index_compares_mtime(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = write_h5ad(tmp_path / "web" / "a.h5ad", ['T cell'])
+    index = DatasetIndex(output=tmp_path / "output.json")
+    index.update([a])
+
+    # Same sampled fingerprint, e.g. an in-place edit between the sampled blocks
+    stats = a.stat()
+    os.utime(a, (stats.st_atime, stats.st_mtime + 10))
+    assert index.update([a]) == [a]
+
+
+class CopyingWatcher:
+    """landed.h5ad arrives once, copying.h5ad grows on every wakeup"""
+
+    def __init__(self, landed, copying):
+        self.landed = landed
+        self.copying = copying
+        self.wakeups = 0
+
+    def read_events(self, timeout=None):
+        self.wakeups += 1
+        assert self.wakeups < 10, "landed.h5ad was never processed"
+        with open(self.copying, 'ab') as fh:
+            fh.write(b"x")
+        return {self.copying} | ({self.landed} if self.wakeups == 1 else set())
+
+    def close(self):
+        pass
+
+
+class RecordingIndex:
+    def __init__(self):
+        self.metadata = {}
+        self.proportions = {}
+        self.stale = set()
+        self.updates = []
+
+    def seed(self):
+        pass
+
+    def update(self, changed):
+        self.updates.append(sorted(changed))
+
+
+def test_watch_debounces_per_file(tmp_path, monkeypatch):
+    landed = tmp_path / "landed.h5ad"
+    landed.write_bytes(b"done")
+    copying = tmp_path / "copying.h5ad"
+    watcher = CopyingWatcher(landed, copying)
+    monkeypatch.setattr(watch, "create_watcher", lambda *args, **kwargs: watcher)
+    clock = itertools.count()
+    monkeypatch.setattr(watch.time, "monotonic", lambda: next(clock))
+
+    index = RecordingIndex()
+    watch.watch_datasets(tmp_path, ('*.h5ad',), index, debounce=2, iterations=1)
+    # landed.h5ad is processed while copying.h5ad is still changing
+    assert index.updates[-1] == [landed]
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_dataset_index_upload_changes(tmp_path, monkeypatch):
+    from scripts import import_metadata_to_supabase as supabase
+
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    monkeypatch.setattr(watch, "upload_cell_type_counts", lambda: calls.append('counts'))
+    monkeypatch.setattr(supabase, "upsert_datasets",
+                        lambda data: calls.append(('upsert', [r['dataset'] for r in data])))
+    monkeypatch.setattr(supabase, "delete_datasets", lambda paths: calls.append(('delete', paths)))
+    a = write_h5ad(tmp_path / "web" / "a.h5ad", ['T cell'])
+    b = write_h5ad(tmp_path / "web" / "b.h5ad", ['B cell'])
+
+    index = DatasetIndex(output=tmp_path / "output.json", upload=True)
+    index.update([a, b])
+    write_h5ad(a, ['monocyte'])
+    b.unlink()
+    calls.clear()
+    index.update([a, b])
+    assert calls == ['counts', ('delete', [str(b)]), ('upsert', ['a.h5ad'])]
+
+
+class OverflowingWatcher:
+    def __init__(self):
+        self.wakeups = 0
+
+    def read_events(self, timeout=None):
+        self.wakeups += 1
+        assert self.wakeups < 10, "the tree was never rescanned"
+        if self.wakeups == 1:
+            raise EventsLost()
+        return set()
+
+    def close(self):
+        pass
+
+
+def test_watch_rescans_after_lost_events(tmp_path, monkeypatch):
+    landed = tmp_path / "landed.h5ad"
+    landed.write_bytes(b"done")
+    removed = tmp_path / "removed.h5ad"
+    monkeypatch.setattr(watch, "create_watcher", lambda *args, **kwargs: OverflowingWatcher())
+    clock = itertools.count()
+    monkeypatch.setattr(watch.time, "monotonic", lambda: next(clock))
+
+    index = RecordingIndex()
+    index.metadata[removed] = None
+    watch.watch_datasets(tmp_path, ('*.h5ad',), index, debounce=2, iterations=1)
+    # Both the file created & the one removed while events were lost
+    assert index.updates[-1] == [landed, removed]